@@ -0,0 +1,46 @@
+# Compares the serializer used by main.py against the pandas DataFrame path it replaced, on rows
+# shaped like the package table. Run with: python bench_serializer.py [rows] [repeats]
+
+import sys
+import timeit
+import decimal
+
+import serializer
+
+COLUMNS = ('id', 'package_id', 'package_name', 'version', 'url', 'jsprogram', 'ramp_up', 'correctness',
+           'bus_factor', 'responsiveness', 'license', 'dependancy', 'overall')
+
+def make_rows(count):
+    return [
+        (i, 'pkg-' + str(i), 'package' + str(i), '1.0.' + str(i), 'https://github.com/owner/repo' + str(i), 'if (x) {}',
+         decimal.Decimal('0.2'), decimal.Decimal('0.2'), decimal.Decimal('0.3'), decimal.Decimal('0.1'),
+         decimal.Decimal('0.1'), decimal.Decimal('0.2'), decimal.Decimal('1.1'))
+        for i in range(count)
+    ]
+
+def pandas_path(rows):
+    import pandas as pd
+    frame = pd.DataFrame(rows)
+    frame.columns = COLUMNS
+    return frame.to_json(orient = 'records')
+
+def serializer_path(rows):
+    return serializer.rows_to(COLUMNS, rows, serializer.to_metadata)
+
+if __name__ == '__main__':
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rows    = make_rows(count)
+
+    paths = [('serializer', serializer_path)]
+    try:
+        start = timeit.default_timer()
+        import pandas
+        print("pandas import:    %8.1f ms (paid once per cold start)" % ((timeit.default_timer() - start) * 1000))
+        paths.insert(0, ('pandas DataFrame', pandas_path))
+    except ImportError:
+        print("pandas is not installed, timing the serializer only")
+
+    for name, path in paths:
+        seconds = min(timeit.repeat(lambda: path(rows), number = repeats, repeat = 3))
+        print("%-17s %8.1f us per response of %d rows" % (name + ':', seconds / repeats * 1e6, count))
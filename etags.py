@@ -0,0 +1,17 @@
+import hashlib
+
+from flask import request
+
+def rows_etag(rows):
+    # Strong ETag for a response built from package rows. The primary key changes when an ID is deleted and
+    # created again and row_version changes on every UPDATE; several rows are hashed into one tag.
+    tag = '-'.join(str(row['id']) + '.' + str(row['row_version']) for row in rows)
+    return tag if len(rows) == 1 else hashlib.sha1(tag.encode()).hexdigest()
+
+def conditional(etag, body):
+    # A 304 if the request's If-None-Match names 'etag', otherwise body() with a 200; both carry the ETag.
+    # Called while handling a request.
+    headers = {'ETag': '"' + etag + '"'}
+    if request.if_none_match.contains(etag):
+        return '', 304, headers
+    return body(), 200, headers
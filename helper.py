@@ -1,22 +1,94 @@
+import os
 import sys
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from numpy import true_divide
-sys.path.insert(0, '/home/mert/Desktop/Berkay/Project-2-11/project-1/')
-# sys.path.append('/home/mert/Desktop/Berkay/Project-2-11/project-1/')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'project-1'))
 from proj1 import *
- 
+from repository import resolve_github_url
+from single_flight import SingleFlight
+from score_cache import SCORED_AT_FORMAT
+import http_cache
 
- 
+BATCH_WORKERS    = int(os.environ.get('BATCH_WORKERS', 8))   # repositories scored at once by score_packages
+INGEST_THRESHOLD = 0.25   # ingestibilty passes when the sub-scores plus 'score', i.e. twice the total, exceed 0.5
 
-def run_scoring():
-    main(['package_url.txt'])
+# Concurrent score_package calls for one repository share a single scoring run
+scoring_flights = SingleFlight()
 
-def write_url(url):
-    with open('package_url.txt', 'w') as url_file:
-        url_file.write(str(url))
+def repository_key(url):
+    # The lower-cased "owner/name" behind a github or npm url, so every spelling of a repository
+    # gets the same key. Falls back to the url itself if it cannot be resolved.
+    try:
+        _, full_name = resolve_github_url(url)
+    except Exception:
+        return url
+    full_name = full_name.strip('/').lower()
+    return full_name[:-len('.git')] if full_name.endswith('.git') else full_name
+
+def score_package(url, cache=None, threshold=None, refresh=False):
+    # Scores the repository behind 'url' and returns its sub-score dictionary. Safe to call from
+    # several request or job threads at once; callers asking for a repository that is already being
+    # scored wait for that run and share its result. If a ScoreCache is given, the scores stored for
+    # the repository's current HEAD are returned when present, and fresh scores are stored otherwise.
+    # With a 'threshold' (INGEST_THRESHOLD to decide ingestibility) metrics only run until it is certain
+    # whether the total ends above it, see proj1.score_url_early. The skipped keys are then None and
+    # listed under 'skipped', and such partial scores are never stored in the cache. 'scored_at' is the
+    # UTC time the scores were computed, earlier than now when they come from the cache. With 'refresh'
+    # the cached scores are not read, and the new ones replace them.
+    key = repository_key(url) if threshold is None else repository_key(url) + '@' + str(threshold)
+    if refresh:
+        key += '@refresh'
+    return dict(scoring_flights.do(key, lambda: score_repository(url, cache, threshold, refresh)))
+
+def score_repository(url, cache=None, threshold=None, refresh=False):
+    def score():
+        scores = score_url(url) if threshold is None else score_url_early(url, threshold)
+        scores['scored_at'] = datetime.datetime.utcnow().strftime(SCORED_AT_FORMAT)
+        return scores
+
+    if cache is None:
+        return score()
+
+    try:
+        repo, head_sha = resolve_repository(url)
+    except Exception as e:
+        print("Could not resolve repository for score cache:", e)
+        return score()
+
+    # New semgrep rules change correctness scores, so the rule-set version is part of the key
+    version = METRICS_VERSION + "+" + ruleset_version()
+    scores  = None if refresh else cache.get(repo, head_sha, version)
+    if scores is None:
+        scores = score()
+        # Partial scores, and scores with a metric imputed after a timeout, do not describe the commit
+        if 'skipped' not in scores and 'imputed' not in scores:
+            cache.put(repo, head_sha, version, scores)
+    return scores
+
+def score_packages(urls, cache=None, threshold=None, workers=BATCH_WORKERS):
+    # Scores several package URLs on at most 'workers' threads, each distinct URL once. Returns a
+    # dictionary from URL to its score dictionary, or to the exception raised while scoring it.
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(score_package, url, cache, threshold): url for url in set(urls)}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+def scoring_stats():
+    # Counters from the scoring pipeline, reported by the /stats route.
+    return {'http_cache': http_cache.stats(), 'single_flight': scoring_flights.stats(), 'metric_costs': metric_costs.stats()}
+
+# The numeric entries of a score dictionary, see proj1.ranking_dict
+SCORE_KEYS = ['ramp_up', 'correctness', 'bus_factor', 'responsiveness', 'license', 'dependency', 'score']
 
 def ingestibilty(dict):
-    values = dict.values()
+    # Metrics skipped by an early-exit evaluation are None; its 'score' is then the lowest total still possible
+    values = [dict[key] for key in SCORE_KEYS if dict[key] is not None]
     final_score = sum(values)
     if final_score > 0.5:
         return True
@@ -25,4 +97,4 @@ def ingestibilty(dict):
 
 if __name__ == '__main__':
     url = 'https://github.com/cloudinary/cloudinary_npm'
-    write_url(url)
+    print(score_package(url))
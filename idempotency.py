@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import threading
+
+IDEMPOTENCY_TTL     = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))   # seconds a finished request is replayed for
+IDEMPOTENCY_WAIT    = float(os.environ.get('IDEMPOTENCY_WAIT', 120))        # seconds a retry waits for the original request
+IDEMPOTENCY_STALE   = int(os.environ.get('IDEMPOTENCY_STALE', 15 * 60))      # seconds before a running request is presumed lost
+IDEMPOTENCY_POLL    = 0.5                                                    # seconds between checks while waiting
+IDEMPOTENCY_PURGE   = 100                                                    # begin() calls between purges of expired keys
+
+RUNNING = 'running'
+DONE    = 'done'
+
+class IdempotencyMismatch(Exception):
+    # Raised by begin() when a key is reused for a request with a different method, path or body.
+    pass
+
+class IdempotencyInProgress(Exception):
+    # Raised by begin() when the original request is still running after IDEMPOTENCY_WAIT seconds.
+    pass
+
+class IdempotencyStore():
+    # Remembers the final status, headers and body of write requests sent with an Idempotency-Key header, in
+    # the idempotency_keys table, so every instance sees them. begin() claims a key for a request; a
+    # retry of a finished request gets the stored response back instead of running again, and a retry
+    # of a request still running waits for it. A claim whose owner never finished (the instance died)
+    # can be taken over after 'stale' seconds. Keys are forgotten 'ttl' seconds after they were claimed.
+
+    def __init__(self, pool, ttl=IDEMPOTENCY_TTL, wait=IDEMPOTENCY_WAIT, stale=IDEMPOTENCY_STALE):
+        self.pool     = pool
+        self.ttl      = ttl
+        self.wait     = wait
+        self.stale    = stale
+        self.__lock   = threading.Lock()
+        self.__begins = 0
+        self.__counts = {'claims': 0, 'replays': 0, 'waits': 0, 'mismatches': 0, 'takeovers': 0, 'abandoned': 0}
+
+    def create_table(self):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                idem_key VARCHAR(255) NOT NULL PRIMARY KEY,
+                request_hash CHAR(64) NOT NULL,
+                state VARCHAR(16) NOT NULL,
+                status SMALLINT NULL,
+                headers TEXT NULL,
+                body MEDIUMTEXT NULL,
+                created_at DATETIME NOT NULL
+            )""")
+            cnx.commit()
+            cursor.close()
+        self.purge()
+
+    def begin(self, key, request_hash):
+        # Returns None if this request now owns 'key' and must run, or the (body, status, headers) to replay.
+        with self.__lock:
+            self.__begins += 1
+            purge = self.__begins % IDEMPOTENCY_PURGE == 0
+        if purge:
+            self.purge()
+
+        deadline = time.monotonic() + self.wait
+        waited   = False
+        while True:
+            with self.pool.connection() as cnx:
+                cursor = cnx.cursor(buffered = True)
+                cursor.execute("DELETE FROM idempotency_keys WHERE idem_key = %s AND created_at < UTC_TIMESTAMP() - INTERVAL %s SECOND",(key, self.ttl))
+                cursor.execute("""
+                INSERT IGNORE INTO idempotency_keys (idem_key, request_hash, state, created_at) VALUES (%s,%s,%s,UTC_TIMESTAMP())""",
+                        (key, request_hash, RUNNING))
+                claimed = cursor.rowcount == 1
+                row     = None
+                if not claimed:
+                    cursor.execute("SELECT request_hash, state, status, body, headers FROM idempotency_keys WHERE idem_key = %s",(key,))
+                    row = cursor.fetchone()
+                    if row is not None and row[0] == request_hash and row[1] == RUNNING:
+                        cursor.execute("""
+                        UPDATE idempotency_keys SET created_at = UTC_TIMESTAMP()
+                        WHERE idem_key = %s AND state = %s AND created_at < UTC_TIMESTAMP() - INTERVAL %s SECOND""",
+                                (key, RUNNING, self.stale))
+                        if cursor.rowcount == 1:
+                            claimed = True
+                            self.__count('takeovers')
+                cnx.commit()
+                cursor.close()
+
+            if claimed:
+                self.__count('claims')
+                return None
+            if row is None:
+                # Expired and deleted between the INSERT and the SELECT, claim it on the next pass
+                continue
+            if row[0] != request_hash:
+                self.__count('mismatches')
+                raise IdempotencyMismatch("Idempotency-Key was already used for a different request")
+            if row[1] == DONE:
+                self.__count('replays')
+                return row[3], row[2], json.loads(row[4]) if row[4] else {}
+
+            if not waited:
+                self.__count('waits')
+                waited = True
+            if time.monotonic() > deadline:
+                raise IdempotencyInProgress("The original request with this Idempotency-Key is still running")
+            time.sleep(IDEMPOTENCY_POLL)
+
+    def finish(self, key, status, body, headers = None):
+        # 'headers' are the response headers to send again with a replay, such as Content-Type and ETag
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("UPDATE idempotency_keys SET state = %s, status = %s, headers = %s, body = %s WHERE idem_key = %s",
+                    (DONE, status, json.dumps(headers or {}), body, key))
+            cnx.commit()
+            cursor.close()
+
+    def abandon(self, key):
+        # Releases a claim whose request failed without a response, so a retry runs it again
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("DELETE FROM idempotency_keys WHERE idem_key = %s AND state = %s",(key, RUNNING))
+            cnx.commit()
+            cursor.close()
+        self.__count('abandoned')
+
+    def purge(self):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("DELETE FROM idempotency_keys WHERE created_at < UTC_TIMESTAMP() - INTERVAL %s SECOND",(self.ttl,))
+            cnx.commit()
+            cursor.close()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counts)
+        stats['ttl'] = self.ttl
+        return stats
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counts[name] += 1
@@ -0,0 +1,105 @@
+import os
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+SCORING_WORKERS    = int(os.environ.get('SCORING_WORKERS', 2))       # concurrent scoring runs
+SCORING_MAX_QUEUED = int(os.environ.get('SCORING_MAX_QUEUED', 100))  # queued jobs before submit() refuses
+SCORING_HISTORY    = int(os.environ.get('SCORING_HISTORY', 1000))    # finished jobs kept for status lookups
+
+QUEUED  = 'queued'
+RUNNING = 'running'
+DONE    = 'done'
+FAILED  = 'failed'
+
+class JobQueueFull(Exception):
+    # Raised by submit() when SCORING_MAX_QUEUED jobs are already waiting for a worker.
+    pass
+
+class ScoringJobs():
+    # Runs package scoring in a bounded pool of background threads and keeps the state of each job
+    # so clients can poll for it. A job's work is any callable returning a JSON-serialisable dict;
+    # its return value becomes the job's result. Job state lives in memory, so it only covers jobs
+    # submitted to this instance and is lost on restart.
+
+    def __init__(self, workers=SCORING_WORKERS, max_queued=SCORING_MAX_QUEUED, history=SCORING_HISTORY):
+        self.max_queued   = max_queued
+        self.history      = history
+        self.__executor   = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scoring')
+        self.__lock       = threading.Lock()
+        self.__jobs       = OrderedDict()
+        self.__by_package = {}
+
+    def submit(self, package_id, work, dedupe=False):
+        # With dedupe, a package that already has a queued or running job gets that job back instead.
+        # 'package_id' may be a list of IDs for one job scoring several packages, such as a batch; the
+        # job is then found under each of them by latest_for_package() and by dedupe.
+        package_ids = package_id if isinstance(package_id, list) else [package_id]
+        with self.__lock:
+            for id in package_ids:
+                if dedupe and id in self.__by_package:
+                    job = self.__jobs[self.__by_package[id]]
+                    if job['Status'] in (QUEUED, RUNNING):
+                        return dict(job)
+
+            queued = sum(1 for job in self.__jobs.values() if job['Status'] == QUEUED)
+            if queued >= self.max_queued:
+                raise JobQueueFull(str(queued) + " scoring jobs are already queued")
+
+            job_id = uuid.uuid4().hex
+            self.__jobs[job_id] = {
+                'JobID'     : job_id,
+                'PackageID' : package_id,
+                'Status'    : QUEUED,
+                'Submitted' : self.__now(),
+                'Started'   : None,
+                'Finished'  : None,
+                'Result'    : None,
+                'Error'     : None,
+            }
+            for id in package_ids:
+                self.__by_package[id] = job_id
+            self.__trim()
+
+        self.__executor.submit(self.__run, job_id, work)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            return dict(job) if job else None
+
+    def latest_for_package(self, package_id):
+        with self.__lock:
+            job_id = self.__by_package.get(package_id)
+        return self.get(job_id) if job_id else None
+
+    def __run(self, job_id, work):
+        self.__update(job_id, Status=RUNNING, Started=self.__now())
+        try:
+            result = work()
+        except Exception as e:
+            traceback.print_exc()
+            self.__update(job_id, Status=FAILED, Finished=self.__now(), Error=str(e))
+            return
+        self.__update(job_id, Status=DONE, Finished=self.__now(), Result=result)
+
+    def __update(self, job_id, **fields):
+        with self.__lock:
+            if job_id in self.__jobs:
+                self.__jobs[job_id].update(fields)
+
+    def __trim(self):
+        # Drop the oldest finished jobs once more than 'history' are held. Caller holds the lock.
+        finished = [job_id for job_id, job in self.__jobs.items() if job['Status'] in (DONE, FAILED)]
+        for job_id in finished[:max(0, len(self.__jobs) - self.history)]:
+            package_id = self.__jobs.pop(job_id)['PackageID']
+            for id in package_id if isinstance(package_id, list) else [package_id]:
+                if self.__by_package.get(id) == job_id:
+                    del self.__by_package[id]
+
+    def __now(self):
+        return datetime.utcnow().isoformat() + 'Z'
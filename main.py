@@ -1,140 +1,731 @@
-from flask import Flask, render_template, redirect, url_for, request, session
+from flask import Flask, Response, render_template, redirect, url_for, request, session, stream_with_context
 from flask_executor import Executor
 from storage import uploadFiles,downloadFiles
-from sqlconnector import connect
+from sqlconnector import ConnectionPool, PoolTimeout, migrate
+from jobs import ScoringJobs, JobQueueFull, FAILED
+from score_cache import ScoreCache
+from response_cache import ResponseCache
+from idempotency import IdempotencyStore, IdempotencyMismatch, IdempotencyInProgress
+from etags import rows_etag, conditional
+from serializer import rows_to, row_dict, to_metadata, to_package, to_rating, to_history_entry, to_export_record, dumps
 import base64
-import pandas as pd
+import functools
+import hashlib
+import datetime
 import json
+import os
 from helper import *
 
 
 app = Flask(__name__)
 executor = Executor(app)
-cnx = connect()
-if not cnx:
-    exit("Error connecting to database")
+pool = ConnectionPool()
+try:
+    pool.release(pool.acquire())
+except Exception as e:
+    exit("Error connecting to database: " + str(e))
+migrate(pool)
+scoring_jobs = ScoringJobs()
+score_cache = ScoreCache(pool)
+score_cache.create_table()
+response_cache = ResponseCache()
+idempotency = IdempotencyStore(pool)
+idempotency.create_table()
+
+PAGE_SIZE     = 10                                          # rows per page when ?page_size is not given
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+SCORE_FRESHNESS = int(os.environ.get('SCORE_FRESHNESS', 24 * 60 * 60))   # seconds before /rate queues a rescore
+RESCORE_BACKOFF = int(os.environ.get('RESCORE_BACKOFF', 60 * 60))        # seconds /rate waits after a failed rescore before queueing another
+EXPORT_BATCH  = int(os.environ.get('EXPORT_BATCH', 500))   # rows fetched per round trip while streaming an export
+BATCH_MAX_PACKAGES = int(os.environ.get('BATCH_MAX_PACKAGES', 500))
+BATCH_SYNC_MAX     = int(os.environ.get('BATCH_SYNC_MAX', 10))      # packages a batch may score within the request, without ?mode=async
+BATCH_INSERT_CHUNK = int(os.environ.get('BATCH_INSERT_CHUNK', 100))   # rows written per transaction by /packages/batch
+BY_IDS_MAX         = int(os.environ.get('BY_IDS_MAX', 1000))         # ids accepted by one /packages/byIds request
+IN_CHUNK           = 500                                              # ids per "WHERE package_id IN (...)" query
+REPLAYED_HEADERS   = ['Content-Type', 'ETag', 'Location']              # response headers an idempotent replay sends again
+
+@app.errorhandler(PoolTimeout)
+def databaseBusy(e):
+    return 'Database busy, try again later', 503
+
+@app.errorhandler(JobQueueFull)
+def scoringBusy(e):
+    return 'Too many packages waiting to be scored, try again later', 503
+
+@app.errorhandler(IdempotencyMismatch)
+def idempotencyMismatch(e):
+    return str(e), 422
+
+@app.errorhandler(IdempotencyInProgress)
+def idempotencyInProgress(e):
+    return str(e), 409
+
+def idempotent(route):
+    # A write route wrapped by this honours an Idempotency-Key header. The first request with a key runs
+    # and its final status, body and REPLAYED_HEADERS are stored; a retry with the same key, method, path and body gets that
+    # response back without running again, and a retry that arrives while the first is still running waits
+    # for it. A request that raised instead of responding releases its key so it can be retried.
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return route(*args, **kwargs)
+        if len(key) > 255:
+            return 'Idempotency-Key must be at most 255 characters', 400
+
+        request_hash = hashlib.sha256(request.method.encode() + b' ' + request.full_path.encode() + b'\n' + request.get_data()).hexdigest()
+        replay = idempotency.begin(key, request_hash)
+        if replay is not None:
+            body, status, headers = replay
+            headers['Idempotent-Replayed'] = 'true'
+            return body, status, headers
+
+        try:
+            response = app.make_response(route(*args, **kwargs))
+        except Exception:
+            idempotency.abandon(key)
+            raise
+        headers = {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+        idempotency.finish(key, response.status_code, response.get_data(as_text = True), headers)
+        return response
+    return wrapper
+
+def isAsync():
+    # POST /package?mode=async and PUT /package/<id>?mode=async record the package and score it in the background
+    return request.args.get('mode') == 'async'
+
+def ingestThreshold():
+    # With ?mode=fast the write routes only run metrics, cheapest first, until ingestibility is decided and
+    # the skipped ones are filled in by a background rescore. Returns the threshold for score_package.
+    return INGEST_THRESHOLD if request.args.get('mode') == 'fast' else None
+
+def storeScores(cursor, id, dict_resp):
+    query = "UPDATE package SET ramp_up = %s, correctness = %s, bus_factor = %s, responsiveness = %s, license = %s, dependancy = %s, overall = %s, imputed = %s, scored_at = %s, row_version = row_version + 1  WHERE package_id = %s;"
+    cursor.execute(query,scoreValues(dict_resp) + (scoredAt(dict_resp), id))
+
+def scoreValues(dict_resp):
+    # The score columns of a package row, in the order storeScores and the batch insert write them. Partial
+    # scores from ?mode=fast leave the skipped metrics and the overall score NULL until they are filled in.
+    # 'imputed' lists, comma separated, the sub-scores whose metric overran its time budget.
+    overall = None if 'skipped' in dict_resp else dict_resp['score']
+    imputed = ','.join(dict_resp.get('imputed', [])) or None
+    return (dict_resp['ramp_up'],dict_resp['correctness'],dict_resp['bus_factor'],dict_resp['responsiveness'],dict_resp['license'],dict_resp['dependency'],overall,imputed)
+
+def scoredAt(dict_resp):
+    # When the scores were computed, which for scores reused from score_cache is earlier than now. Partial
+    # scores have no time, so /rate treats them as stale.
+    if 'skipped' in dict_resp:
+        return None
+    return dict_resp.get('scored_at') or datetime.datetime.utcnow().strftime(SCORED_AT_FORMAT)
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def selectByIds(cursor, ids, columns = '*'):
+    # Rows of the package table whose package_id is in 'ids', as dictionaries, looked up IN_CHUNK ids per query
+    rows = []
+    for chunk in chunks(list(ids), IN_CHUNK):
+        placeholders = ','.join(['%s'] * len(chunk))
+        cursor.execute("SELECT " + columns + " FROM package WHERE package_id IN (" + placeholders + ")",tuple(chunk))
+        rows.extend(row_dict(cursor.column_names, row) for row in cursor.fetchall())
+    return rows
+
+def existingIds(cursor, ids):
+    # The subset of 'ids' already in the package table
+    return {row['package_id'] for row in selectByIds(cursor, ids, 'package_id')}
+
+def afterWrite(ids = (), names = (), everything = False):
+    # Every route that changes package rows calls this once its transaction is committed, passing the
+    # package IDs and names it touched, so no cached response built from the old rows is served again.
+    if everything:
+        response_cache.clear()
+    else:
+        response_cache.invalidate(['id:' + str(id) for id in ids] + ['name:' + str(name) for name in names])
+
+def readThrough(key, load, shape, revalidate = None):
+    # Serves the response for 'key' from response_cache. Otherwise load() returns the package rows it is
+    # built from (empty if the package does not exist) and shape(rows) is cached tagged with those rows.
+    # A request whose If-None-Match already names the rows' ETag gets a 304 and no body is serialized.
+    # revalidate(rows), if given, is called with the rows behind every response served.
+    cached = response_cache.get(key)
+    if cached is not None:
+        body, etag, rows = cached
+        if revalidate:
+            revalidate(rows)
+        return conditional(etag, lambda: body)
+
+    generation = response_cache.generation()
+    rows = load()
+    if not rows:
+        return 'Package not found', 400
+    if revalidate:
+        revalidate(rows)
+    etag = rows_etag(rows)
+    if request.if_none_match.contains(etag):
+        return conditional(etag, None)
+    body = shape(rows)
+    tags = ['id:' + str(row['package_id']) for row in rows] + ['name:' + str(row['package_name']) for row in rows]
+    response_cache.put(key, (body, etag, rows), tags, generation)
+    return conditional(etag, lambda: body)
+
+def bumpGeneration(cursor):
+    # Called inside every transaction that writes the package table, so the listing ETags change with it
+    cursor.execute("UPDATE registry_meta SET value = value + 1 WHERE name = 'generation'")
+
+def listingETag(cursor):
+    # ETag of a listing page. Read in the same transaction as the page so both come from one snapshot.
+    cursor.execute("SELECT value FROM registry_meta WHERE name = 'generation'")
+    return 'g' + str(cursor.fetchone()[0])
+
+def scoreInBackground(id, url, created):
+    # The 202 response of a write route that left scoring to a background job, see queueScoring
+    return json.dumps(queueScoring(id, url, created)), 202
+
+def queueScoring(id, url, created):
+    # Queues a scoring job for a package that is already recorded. When the job finishes the scores
+    # are stored if the package is ingestible; a newly created package that fails ingestibility, or
+    # whose repository could not be scored, is removed again, as the synchronous path would never have
+    # inserted it. A failed job reports its error through /rate/status. A new package's files are only
+    # uploaded once it has been accepted.
+    def work():
+        try:
+            dict_resp = score_package(url, score_cache)
+        except Exception:
+            if created:
+                removeCreated([id])
+            raise
+        isIngest  = ingestibilty(dict_resp)
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            if isIngest is True:
+                storeScores(cursor, id, dict_resp)
+            elif created:
+                cursor.execute("DELETE FROM package WHERE package_id = %s",(id,))
+            bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+        afterWrite(ids = [id])
+        if created and isIngest is True:
+            # Already off the request thread, and the executor can only be given work from inside a request
+            uploadFiles(id)
+        return {'Ingestible': isIngest is True, 'Scores': dict_resp}
+
+    job = scoring_jobs.submit(id, work)
+    job['StatusURL'] = url_for('rateStatus', id = id)
+    return job
+
+def removeCreated(ids):
+    # Deletes packages recorded by an async create whose scoring failed or that failed ingestibility
+    for chunk in chunks(list(ids), IN_CHUNK):
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("DELETE FROM package WHERE package_id IN (" + ','.join(['%s'] * len(chunk)) + ")",tuple(chunk))
+            bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+    afterWrite(ids = ids)
+
+def pageSize():
+    # ?page_size=N on the listing routes, clamped to 1..MAX_PAGE_SIZE
+    try:
+        size = int(request.args.get('page_size', PAGE_SIZE))
+    except ValueError:
+        size = PAGE_SIZE
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def encodeCursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode()
+
+def decodeCursor(token):
+    # An empty cursor starts at the first page. Raises ValueError for a token this server did not issue.
+    if not token:
+        return 0
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(token.encode()))['id'])
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+@app.route('/stats', methods = ['GET'])
+def getStats():
+    stats = {'db_pool': pool.stats(), 'score_cache': score_cache.stats(), 'response_cache': response_cache.stats(), 'idempotency': idempotency.stats()}
+    stats.update(scoring_stats())
+    return json.dumps(stats), 200
 
 @app.route('/packages/',defaults = {'offset' : 1})
 @app.route('/packages/<int:offset>',methods = ['GET']) #essential
 def getPackages(offset):
-    cursor = cnx.cursor(buffered = True)
-    query = "SELECT * FROM package ORDER BY id LIMIT %s,10;"
-    cursor.execute(query,((offset-1)*10 if offset > 0 else 0,))
-    resp = pd.DataFrame(cursor.fetchall())
-    cnx.commit()
-    resp.columns = cursor.column_names
-    resp = resp.to_json(orient='records')
-    cursor.close()
-    return resp
+    if 'cursor' in request.args:
+        return getPackagesAfter(request.args.get('cursor'))
+
+    size = pageSize()
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        etag = listingETag(cursor)
+        if request.if_none_match.contains(etag):
+            cursor.close()
+            return conditional(etag, None)
+        query = "SELECT * FROM package ORDER BY id LIMIT %s,%s;"
+        cursor.execute(query,((offset-1)*size if offset > 0 else 0,size))
+        resp = rows_to(cursor.column_names, cursor.fetchall(), to_metadata)
+        cnx.commit()
+        cursor.close()
+    return conditional(etag, lambda: resp)
+
+def getPackagesAfter(token):
+    # GET /packages/?cursor=<token>&page_size=N pages by the last id seen instead of an offset, so every
+    # page costs the same however deep it is. Start with an empty cursor and follow 'next' until it is null.
+    try:
+        last_id = decodeCursor(token)
+    except ValueError as e:
+        return str(e), 400
+
+    size = pageSize()
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        etag = listingETag(cursor)
+        if request.if_none_match.contains(etag):
+            cursor.close()
+            return conditional(etag, None)
+        query = "SELECT * FROM package WHERE id > %s ORDER BY id LIMIT %s;"
+        cursor.execute(query,(last_id,size + 1))
+        rows = cursor.fetchall()
+        columns = cursor.column_names
+        cursor.close()
+
+    next_token = encodeCursor(rows[size - 1][columns.index('id')]) if len(rows) > size else None
+    packages = [to_metadata(row_dict(columns, row)) for row in rows[:size]]
+    return conditional(etag, lambda: dumps({"packages": packages, "next": next_token}))
+
+@app.route('/packages/export', methods = ['GET'])
+def exportPackages():
+    # Streams every package with its rating as one JSON object per line, or as a single JSON array with
+    # ?format=json. Rows are read from an unbuffered cursor EXPORT_BATCH at a time, so memory does not grow
+    # with the registry. ?since=<ISO 8601, UTC> or an If-Modified-Since header limits the export to rows
+    # changed at or after that time; deleted packages are not reported by an incremental export.
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'json'):
+        return 'format must be ndjson or json', 400
+    try:
+        since = exportSince()
+    except ValueError as e:
+        return str(e), 400
+
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("SELECT MAX(updated_at) FROM package")
+        last_modified = cursor.fetchone()[0]
+        cursor.close()
+    if request.if_modified_since is not None and since is not None and (last_modified is None or last_modified < since):
+        return '', 304
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    response = Response(stream_with_context(streamExport(since, fmt)), mimetype = mimetype)
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo = datetime.timezone.utc)
+    return response
+
+def exportSince():
+    # Naive UTC datetime from ?since or If-Modified-Since, None for a full export
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since.replace('Z', '+00:00'))
+        except ValueError:
+            raise ValueError('since must be an ISO 8601 timestamp')
+    else:
+        since = request.if_modified_since
+    if since is not None and since.tzinfo is not None:
+        since = since.astimezone(datetime.timezone.utc).replace(tzinfo = None)
+    return since
+
+def streamExport(since, fmt):
+    # Holds one pooled connection for the whole stream. If the client disconnects, the generator is closed
+    # with rows still unread. Rolling back, or closing the cursor, would first read every remaining row, so
+    # the connection is shut down and dropped from the pool instead.
+    cnx = pool.acquire()
+    finished = False
+    try:
+        cursor = cnx.cursor()
+        if since is None:
+            cursor.execute("SELECT * FROM package ORDER BY id")
+        else:
+            cursor.execute("SELECT * FROM package WHERE updated_at >= %s ORDER BY updated_at, id",(since,))
+        columns = cursor.column_names
+
+        if fmt == 'json':
+            yield '['
+        first = True
+        rows = cursor.fetchmany(EXPORT_BATCH)
+        while rows:
+            for row in rows:
+                record = dumps(to_export_record(row_dict(columns, row)))
+                if fmt == 'json':
+                    yield record if first else ',' + record
+                else:
+                    yield record + '\n'
+                first = False
+            rows = cursor.fetchmany(EXPORT_BATCH)
+        if fmt == 'json':
+            yield ']'
+        cursor.close()
+        finished = True
+    finally:
+        if finished:
+            pool.release(cnx)
+        else:
+            pool.discard(cnx)
 
 @app.route('/reset', methods = ['DELETE'])
 def registryReset():
-    cursor = cnx.cursor(buffered = True)
-    query = "DELETE FROM package;"
-    cursor.execute(query)
-    cnx.commit()
-    cursor.close()
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        query = "DELETE FROM package;"
+        cursor.execute(query)
+        bumpGeneration(cursor)
+        cnx.commit()
+        cursor.close()
+    afterWrite(everything = True)
     return 'Reset Registry'
 
+@app.route('/scores/cache', methods = ['DELETE'])
+def invalidateScoreCache():
+    # Drops stored scores so the next upload rescores from scratch. ?repo=owner/name limits this to one repository.
+    deleted = score_cache.invalidate(request.args.get('repo'))
+    return f'Invalidated {deleted} stored scores', 200
+
 @app.route('/package/<id>', methods = ['DELETE']) #essential
 def deletePackage(id):
     #Delete from package id
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute("DELETE FROM package WHERE package_id = %s",(id,))
-    cursor.execute("SELECT ROW_COUNT()")
-    cnx.commit()
-    if cursor.fetchone()[0] == 0:
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("DELETE FROM package WHERE package_id = %s",(id,))
+        cursor.execute("SELECT ROW_COUNT()")
+        deleted = cursor.fetchone()[0]
+        bumpGeneration(cursor)
+        cnx.commit()
+        cursor.close()
+    afterWrite(ids = [id])
+    if deleted == 0:
         return 'Package not found', 400
     return 'Package Deleted',200
 
 @app.route('/package/<id>', methods = ['PUT']) 
+@idempotent
 def updatePackage(id):
     #Update package
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute("SELECT * FROM package WHERE package_id = %s",(id,))
-    if cursor.rowcount == 0:
-        return 'Package not found', 400
     data = request.get_json()
-    query = "UPDATE package SET package_name = %s, version = %s, url = %s, jsprogram = %s  WHERE package_id = %s;"
-    cursor.execute(query,(data['metadata']['Name'],data['metadata']['Version'],data['data']['URL'],data['data']['JSProgram'],id))
-    cnx.commit()
-    write_url(data['data']['URL'])
-    run_scoring()
-    with open("dict.txt") as fptr:
-        dict_resp = json.loads(fptr.read())
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("SELECT * FROM package WHERE package_id = %s",(id,))
+        if cursor.rowcount == 0:
+            cursor.close()
+            return 'Package not found', 400
+        query = "UPDATE package SET package_name = %s, version = %s, url = %s, jsprogram = %s, row_version = row_version + 1  WHERE package_id = %s;"
+        cursor.execute(query,(data['metadata']['Name'],data['metadata']['Version'],data['data']['URL'],data['data']['JSProgram'],id))
+        bumpGeneration(cursor)
+        cnx.commit()
+        cursor.close()
+    afterWrite(ids = [id], names = [data['metadata']['Name']])
+
+    if isAsync():
+        return scoreInBackground(id, data['data']['URL'], created = False)
+
+    # Score without holding a pooled connection, scoring can take tens of seconds
+    dict_resp = score_package(data['data']['URL'], score_cache, ingestThreshold())
     isIngest = ingestibilty(dict_resp)
     if (isIngest) is not True:
-        cursor.close()
         return "Ingestibility failed. Package was not uploaded to database.", 403
-    query = "UPDATE package SET ramp_up = %s, correctness = %s, bus_factor = %s, responsiveness = %s, license = %s, dependancy = %s, overall = %s  WHERE package_id = %s;"
-    cursor.execute(query,(dict_resp['ramp_up'],dict_resp['correctness'],dict_resp['bus_factor'],dict_resp['responsiveness'],dict_resp['license'],dict_resp['dependency'],dict_resp['score'], data['metadata']['ID']))#dict_resp['correctness'],dict_resp['bus_factor'],dict_resp['responsiveness'],dict_resp['license'],dict_resp['dependency'],dict_resp['score'],id))    
-    cnx.commit()
+
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        storeScores(cursor, id, dict_resp)
+        bumpGeneration(cursor)
+        cnx.commit()
+        cursor.close()
+    afterWrite(ids = [id])
+    if 'skipped' in dict_resp:
+        rescore(id, data['data']['URL'])
     return f'Updated package {id}',200
 
 @app.route('/package/<id>', methods = ['GET'])
 def packageRetrieve(id):
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute("SELECT * FROM package WHERE package_id = %s",(id,))
-    packageData = pd.DataFrame(cursor.fetchall())
-    if packageData.empty:
-        return 'Package not found', 400
-    packageData.columns = cursor.column_names
-    print(packageData)
-    resp = packageData.to_json(orient='records')
-    resp = resp[1:-1] #remove first and last element
-    resp = "{" + resp + "}"
-    print(resp,type(resp))
-    return resp, 200
+    def load():
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("SELECT * FROM package WHERE package_id = %s",(id,))
+            row = cursor.fetchone()
+            columns = cursor.column_names
+            cursor.close()
+        return [row_dict(columns, row)] if row else []
+    return readThrough(('package', id), load, lambda rows: dumps(to_package(rows[0])))
 
 @app.route('/package', methods = ['POST']) #essential
+@idempotent
 def packageCreate():
     ''' upload file to gcp storage bucket'''
     req = request.get_json()
     if not (req and req['metadata']['Name'] and req['metadata']['Version']):
         return 'Invalid Request', 400
-    cursor = cnx.cursor(buffered = True)
     #Check if package exists
-    cursor.execute("SELECT * FROM package WHERE package_id = %s",(req['metadata']['ID'],))
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("SELECT * FROM package WHERE package_id = %s",(req['metadata']['ID'],))
+        exists = cursor.fetchone()
+        cursor.close()
+
+    if exists:
+        return "Package ID already exists. Choose a different ID.", 403
+
+    if isAsync():
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("""
+            INSERT INTO package (id, package_id, package_name, version, url, jsprogram) VALUES (id,%s,%s,%s,%s,%s)""",
+                    (req['metadata']['ID'],req['metadata']['Name'] , req['metadata']['Version'] , req['data']['URL'] , req['data']['JSProgram']))
+            bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+        afterWrite(ids = [req['metadata']['ID']], names = [req['metadata']['Name']])
+        return scoreInBackground(req['metadata']['ID'], req['data']['URL'], created = True)
+
+    # Rate here, without holding a pooled connection while the repository is scored
+    dict_resp = score_package(req['data']['URL'], score_cache, ingestThreshold())
+    isIngest = ingestibilty(dict_resp)
+    if (isIngest) is not True:
+        return "Ingestibility failed. Package was not uploaded to database.", 403
 
-    if not cursor.fetchone():
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        # Another request may have created the same ID while this one was scoring
+        cursor.execute("SELECT * FROM package WHERE package_id = %s",(req['metadata']['ID'],))
+        if cursor.fetchone():
+            cursor.close()
+            return "Package ID already exists. Choose a different ID.", 403
         cursor.execute("""
         INSERT INTO package (id, package_id, package_name, version, url, jsprogram) VALUES (id,%s,%s,%s,%s,%s)""",
                 (req['metadata']['ID'],req['metadata']['Name'] , req['metadata']['Version'] , req['data']['URL'] , req['data']['JSProgram']))
-        # Rate here
-        write_url(req['data']['URL'])
-        run_scoring()
-        with open("dict.txt") as fptr:
-            dict_resp = json.loads(fptr.read())
-        isIngest = ingestibilty(dict_resp)
-        if (isIngest) is not True:
-            cursor.close()
-            return "Ingestibility failed. Package was not uploaded to database.", 403
-        print(isIngest)
-        print(dict_resp)
-    
-        # cursor.execute("""
-        # INSERT INTO package (ramp_up, correctness, bus_factor, responsiveness, license, dependancy, overall) VALUES (%s,%s,%s,%s,%s,%s,%s)""",
-        #         (req['metadata']['ID'],req['metadata']['Name'] , req['metadata']['Version'] , req['data']['URL'] , req['data']['JSProgram']))
-        # #, correctness = %d, bus_factor = %d, responsiveness = %d, license = %d, dependancy = %d, overall = %d 
-        # # cursor.execute(query,('0.0','0.0','0.0','0.0','0.0','0.0','0.0',id))
-        # print(type(dict_resp['ramp_up']))
-        query = "UPDATE package SET ramp_up = %s, correctness = %s, bus_factor = %s, responsiveness = %s, license = %s, dependancy = %s, overall = %s  WHERE package_id = %s;"
-        cursor.execute(query,(dict_resp['ramp_up'],dict_resp['correctness'],dict_resp['bus_factor'],dict_resp['responsiveness'],dict_resp['license'],dict_resp['dependency'],dict_resp['score'], req['metadata']['ID']))#dict_resp['correctness'],dict_resp['bus_factor'],dict_resp['responsiveness'],dict_resp['license'],dict_resp['dependency'],dict_resp['score'],id))
-        
+        storeScores(cursor, req['metadata']['ID'], dict_resp)
+        bumpGeneration(cursor)
         cnx.commit()
-        cursor.execute("SELECT * FROM package WHERE package_id = %s",(req['metadata']['ID'],))
-        resp = pd.DataFrame(cursor.fetchall())
-        resp.columns = cursor.column_names
-        resp = resp.to_json(orient='records')
-
-        
-        executor.submit(uploadFiles,req['metadata']['ID'],)
-        return resp[1:-1], 201
-    else:
         cursor.close()
-        return "Package ID already exists. Choose a different ID.", 403
+    afterWrite(ids = [req['metadata']['ID']], names = [req['metadata']['Name']])
+    if 'skipped' in dict_resp:
+        rescore(req['metadata']['ID'], req['data']['URL'])
+
+    executor.submit(uploadFiles,req['metadata']['ID'],)
+    return dumps({'Name': req['metadata']['Name'], 'Version': req['metadata']['Version'], 'ID': req['metadata']['ID']}), 201
     #return 'Creating package'
 
+@app.route('/packages/batch', methods = ['POST'])
+@idempotent
+def packageBatchCreate():
+    # Creates up to BATCH_MAX_PACKAGES packages in one request. The body is a JSON array of Package objects
+    # as POSTed to /package. Repositories are scored concurrently (see helper.score_packages) and accepted
+    # rows are inserted BATCH_INSERT_CHUNK per transaction. Every item gets a result, in input order, whose
+    # Status is created, rejected (failed ingestibility), duplicate (ID already in the registry or earlier
+    # in the batch), invalid (missing Name, Version, ID or URL) or failed (the repository could not be scored).
+    # ?mode=fast scores each repository only as far as ingestibility needs, as for POST /package. Scoring
+    # within the request is limited to BATCH_SYNC_MAX packages; larger batches need ?mode=async.
+    req = request.get_json(silent = True)
+    if not isinstance(req, list):
+        return 'Expected a JSON array of packages', 400
+    if len(req) > BATCH_MAX_PACKAGES:
+        return f'At most {BATCH_MAX_PACKAGES} packages per batch', 400
+    if len(req) > BATCH_SYNC_MAX and not isAsync():
+        return f'At most {BATCH_SYNC_MAX} packages per batch without ?mode=async', 400
+
+    results = [{'ID': None, 'Status': None} for item in req]
+    pending = {}    # index in req -> package, for items still to be scored
+    seen    = set()
+    for i, item in enumerate(req):
+        if not validPackage(item):
+            results[i]['Status'] = 'invalid'
+            continue
+        results[i]['ID'] = item['metadata']['ID']
+        if item['metadata']['ID'] in seen:
+            results[i]['Status'] = 'duplicate'
+            continue
+        seen.add(item['metadata']['ID'])
+        pending[i] = item
+
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        existing = existingIds(cursor, [item['metadata']['ID'] for item in pending.values()])
+        cursor.close()
+    for i in [i for i, item in pending.items() if item['metadata']['ID'] in existing]:
+        results[i]['Status'] = 'duplicate'
+        del pending[i]
+
+    if isAsync():
+        return queueBatch(results, pending)
+
+    # Score without holding a pooled connection
+    scores   = score_packages([item['data']['URL'] for item in pending.values()], score_cache, ingestThreshold())
+    accepted = []
+    for i, item in pending.items():
+        dict_resp = scores[item['data']['URL']]
+        if isinstance(dict_resp, Exception):
+            results[i]['Status'] = 'failed'
+            results[i]['Error']  = str(dict_resp)
+        elif ingestibilty(dict_resp) is not True:
+            results[i]['Status'] = 'rejected'
+        else:
+            accepted.append((i, item, dict_resp))
+
+    query = """
+    INSERT INTO package (package_id, package_name, version, url, jsprogram, ramp_up, correctness, bus_factor, responsiveness, license, dependancy, overall, imputed, scored_at)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"""
+    for chunk in chunks(accepted, BATCH_INSERT_CHUNK):
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            # Another request may have created some of these IDs while the batch was scoring
+            existing = existingIds(cursor, [item['metadata']['ID'] for i, item, dict_resp in chunk])
+            rows = []
+            for i, item, dict_resp in chunk:
+                if item['metadata']['ID'] in existing:
+                    results[i]['Status'] = 'duplicate'
+                    continue
+                rows.append((item['metadata']['ID'],item['metadata']['Name'],item['metadata']['Version'],item['data']['URL'],item['data'].get('JSProgram'))
+                            + scoreValues(dict_resp) + (scoredAt(dict_resp),))
+                results[i]['Status'] = 'created'
+            if rows:
+                cursor.executemany(query, rows)
+                bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+
+    created = [(item, dict_resp) for i, item, dict_resp in accepted if results[i]['Status'] == 'created']
+    afterWrite(ids = [item['metadata']['ID'] for item, dict_resp in created], names = [item['metadata']['Name'] for item, dict_resp in created])
+    for item, dict_resp in created:
+        executor.submit(uploadFiles,item['metadata']['ID'],)
+        if 'skipped' in dict_resp:
+            rescore(item['metadata']['ID'], item['data']['URL'])
+
+    counts = {}
+    for result in results:
+        counts[result['Status']] = counts.get(result['Status'], 0) + 1
+    return dumps({'results': results, 'counts': counts}), 200
+
+def queueBatch(results, pending):
+    # POST /packages/batch?mode=async records every valid new package straight away and answers 202. The
+    # whole batch is scored by one background job (see scoreBatch), so it takes a single place in the job
+    # queue however many packages it holds. Every recorded item gets Status queued with the job's JobID and
+    # a StatusURL, where the job's Result gives each item's final Status once it has run. If the job queue
+    # is full the recorded packages are removed again and the request gets a 503.
+    query = "INSERT INTO package (package_id, package_name, version, url, jsprogram) VALUES (%s,%s,%s,%s,%s)"
+    inserted = []
+    for chunk in chunks(list(pending.items()), BATCH_INSERT_CHUNK):
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            existing = existingIds(cursor, [item['metadata']['ID'] for i, item in chunk])
+            rows = []
+            for i, item in chunk:
+                if item['metadata']['ID'] in existing:
+                    results[i]['Status'] = 'duplicate'
+                    continue
+                rows.append((item['metadata']['ID'],item['metadata']['Name'],item['metadata']['Version'],item['data']['URL'],item['data'].get('JSProgram')))
+                inserted.append((i, item))
+            if rows:
+                cursor.executemany(query, rows)
+                bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+    afterWrite(ids = [item['metadata']['ID'] for i, item in inserted], names = [item['metadata']['Name'] for i, item in inserted])
+
+    if inserted:
+        try:
+            job = scoring_jobs.submit([item['metadata']['ID'] for i, item in inserted], lambda: scoreBatch([item for i, item in inserted]))
+        except JobQueueFull:
+            removeCreated([item['metadata']['ID'] for i, item in inserted])
+            raise
+    for i, item in inserted:
+        results[i]['Status']    = 'queued'
+        results[i]['JobID']     = job['JobID']
+        results[i]['StatusURL'] = url_for('rateStatus', id = item['metadata']['ID'])
+
+    counts = {}
+    for result in results:
+        counts[result['Status']] = counts.get(result['Status'], 0) + 1
+    return dumps({'results': results, 'counts': counts}), 202
+
+def scoreBatch(items):
+    # The work of a batch job. Scores the packages recorded by queueBatch together, as the synchronous path
+    # does, stores the scores of those that pass ingestibility and removes the rest again. Returns the ID
+    # and final Status (created, rejected or failed) of each item, in input order.
+    try:
+        scores = score_packages([item['data']['URL'] for item in items], score_cache)
+    except Exception:
+        removeCreated([item['metadata']['ID'] for item in items])
+        raise
+
+    results  = []
+    accepted = []
+    removed  = []
+    for item in items:
+        id        = item['metadata']['ID']
+        dict_resp = scores[item['data']['URL']]
+        if isinstance(dict_resp, Exception):
+            results.append({'ID': id, 'Status': 'failed', 'Error': str(dict_resp)})
+            removed.append(id)
+        elif ingestibilty(dict_resp) is not True:
+            results.append({'ID': id, 'Status': 'rejected'})
+            removed.append(id)
+        else:
+            results.append({'ID': id, 'Status': 'created'})
+            accepted.append((id, dict_resp))
+
+    for chunk in chunks(accepted, BATCH_INSERT_CHUNK):
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            for id, dict_resp in chunk:
+                storeScores(cursor, id, dict_resp)
+            bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+    afterWrite(ids = [id for id, dict_resp in accepted])
+    if removed:
+        removeCreated(removed)
+    for id, dict_resp in accepted:
+        uploadFiles(id)
+    return {'results': results}
+
+@app.route('/packages/byIds', methods = ['POST'])
+def getPackagesByIds():
+    # Fetches many packages in one request. The body is {"IDs": [...], "include": ["package", "rating"]},
+    # or just the array of IDs to get both. The response maps each found ID to its Package under "packages"
+    # and to its PackageRating under "ratings", and lists IDs that are not in the registry under "missing".
+    req = request.get_json(silent = True)
+    if isinstance(req, list):
+        req = {'IDs': req}
+    if not isinstance(req, dict) or not isinstance(req.get('IDs'), list):
+        return 'Expected {"IDs": [...]}', 400
+    ids     = list(dict.fromkeys(str(id) for id in req['IDs']))
+    include = req.get('include', ['package', 'rating'])
+    if len(ids) > BY_IDS_MAX:
+        return f'At most {BY_IDS_MAX} IDs per request', 400
+    if not isinstance(include, list) or not include or not set(include) <= {'package', 'rating'}:
+        return 'include must list package and/or rating', 400
+
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        rows = selectByIds(cursor, ids)
+        cursor.close()
+
+    found = {row['package_id']: row for row in rows}
+    resp  = {}
+    if 'package' in include:
+        resp['packages'] = {id: to_package(row) for id, row in found.items()}
+    if 'rating' in include:
+        resp['ratings'] = {id: to_rating(row) for id, row in found.items()}
+    resp['missing'] = [id for id in ids if id not in found]
+    return dumps(resp), 200
+
+def validPackage(item):
+    try:
+        return bool(item['metadata']['Name'] and item['metadata']['Version'] and item['metadata']['ID'] and item['data']['URL'])
+    except (KeyError, TypeError):
+        return False
+
 '''
 @app.before_request
 def validate_token():
@@ -171,42 +762,88 @@ def getPackageByName(name):
     """
     select * from database where packageName == Name
     """
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute("SELECT * FROM package WHERE package_name = %s",(name,))
-    packageData = pd.DataFrame(cursor.fetchall())
-    if packageData.empty:
-        return 'Package not found', 400
-    packageData.columns = cursor.column_names
-    print(packageData)
-    resp = packageData.to_json(orient='records')
-    resp = resp[1:-1] #remove first and last element 
-    resp = "{" + resp + "}"
-    print(resp,type(resp))
-    return resp, 200
+    def load():
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("SELECT * FROM package WHERE package_name = %s ORDER BY id",(name,))
+            rows = [row_dict(cursor.column_names, row) for row in cursor.fetchall()]
+            cursor.close()
+        return rows
+    return readThrough(('byName', name), load, lambda rows: dumps([to_history_entry(row) for row in rows]))
 
 
 @app.route('/package/byName/<name>', methods = ['DELETE'])
 def deletePackageByName(name): #essential
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute("DELETE FROM package WHERE package_name = %s",(name,))
-    cursor.execute("SELECT ROW_COUNT()")
-    cnx.commit()
-    if cursor.fetchone()[0] == 0:
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("DELETE FROM package WHERE package_name = %s",(name,))
+        cursor.execute("SELECT ROW_COUNT()")
+        deleted = cursor.fetchone()[0]
+        bumpGeneration(cursor)
+        cnx.commit()
+        cursor.close()
+    afterWrite(names = [name])
+    if deleted == 0:
         return 'Package not found', 400
     return 'Package Deleted',200
 
 @app.route('/package/<id>/rate', methods = ['GET']) #essential
 def rate(id):
-    
-    cursor = cnx.cursor(buffered = True)
-    cursor.execute(("SELECT * FROM package WHERE package_id = %s"),(id,))
-    
-    frame = pd.DataFrame(cursor.fetchall())
-    if frame.empty:
-        return 'Package not found', 400
-    frame.columns = cursor.column_names
-    resp = frame.to_json(orient='records')
-    return resp,200
+    def load():
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute(("SELECT * FROM package WHERE package_id = %s"),(id,))
+            row = cursor.fetchone()
+            columns = cursor.column_names
+            cursor.close()
+        return [row_dict(columns, row)] if row else []
+    return readThrough(('rate', id), load, lambda rows: dumps(to_rating(rows[0])), rescoreIfStale)
+
+def rescoreIfStale(rows):
+    # /rate answers from the stored scores straight away. Scores computed more than SCORE_FRESHNESS seconds
+    # ago (or never) are refreshed by a background job, at most one per package at a time; later reads
+    # see the new scores and ScoredAt. A full job queue just leaves the refresh to a later read, and after
+    # a failed refresh the next one waits RESCORE_BACKOFF seconds.
+    row = rows[0]
+    fresh_after = datetime.datetime.utcnow() - datetime.timedelta(seconds = SCORE_FRESHNESS)
+    if row['scored_at'] is not None and row['scored_at'] > fresh_after:
+        return
+    job = scoring_jobs.latest_for_package(row['package_id'])
+    if job is not None and job['Status'] == FAILED:
+        retry_after = datetime.datetime.fromisoformat(job['Finished'].rstrip('Z')) + datetime.timedelta(seconds = RESCORE_BACKOFF)
+        if datetime.datetime.utcnow() < retry_after:
+            return
+    rescore(row['package_id'], row['url'])
+
+def rescore(id, url):
+    # Fully scores an accepted package in the background and stores the result, unless a job for it is
+    # already queued or running. Also fills in the metrics a ?mode=fast upload skipped. The score cache is
+    # bypassed, as scores reused from it would keep the stale ScoredAt that asked for the rescore.
+    def work():
+        # The package was accepted already, so the new scores are stored whether or not they pass ingestibility
+        dict_resp = score_package(url, score_cache, refresh = True)
+        with pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            storeScores(cursor, id, dict_resp)
+            bumpGeneration(cursor)
+            cnx.commit()
+            cursor.close()
+        afterWrite(ids = [id])
+        return {'Ingestible': ingestibilty(dict_resp) is True, 'Scores': dict_resp}
+
+    try:
+        scoring_jobs.submit(id, work, dedupe = True)
+    except JobQueueFull:
+        pass
+
+@app.route('/package/<id>/rate/status', methods = ['GET'])
+def rateStatus(id):
+    # State of the most recent background scoring job for a package: queued, running, done or failed.
+    # A finished job's Result holds the sub-scores and whether the package passed ingestibility.
+    job = scoring_jobs.latest_for_package(id)
+    if job is None:
+        return 'No scoring job found for package', 400
+    return json.dumps(job), 200
     
 
 @app.route('/')
@@ -0,0 +1,115 @@
+import os
+import shutil
+import subprocess
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from log import log
+
+CLONE_DIR   = os.environ.get("CLONE_CACHE_DIR", "repositories")
+GIT_TIMEOUT = int(os.environ.get("GIT_TIMEOUT", 300)) # seconds allowed for a single git command
+
+class GitError(Exception):
+    # Raised when a git command fails or runs past its timeout.
+    pass
+
+class CloneCache():
+    # Keeps one working copy per repository under <directory>/<owner>/<repo>. New entries are
+    # shallow, blobless clones of the default branch. Existing entries are brought up to the
+    # current default branch HEAD with a depth 1 fetch and a hard reset instead of being cloned
+    # again. Work on an entry is serialized between threads and, where fcntl is available,
+    # between processes, so concurrent scorers never clone the same repository twice.
+
+    def __init__(self, directory=CLONE_DIR, timeout=GIT_TIMEOUT):
+        self.directory = directory
+        self.timeout   = timeout
+        self.__lock    = threading.Lock()
+        self.__locks   = {}
+
+    def checkout(self, repo, timeout=None):
+        # Returns the path of an up-to-date working copy of 'repo', which needs a 'full_name'
+        # ("owner/name") and a 'url'.
+        path = os.path.join(self.directory, *repo.full_name.split("/"))
+
+        with self.__entry_lock(path):
+            if os.path.isdir(os.path.join(path, ".git")):
+                try:
+                    self.__update(path, timeout)
+                    log.log_clone_updated(repo.full_name, path)
+                    return path
+                except GitError as e:
+                    log.log_clone_failed(repo.full_name, e)
+                    shutil.rmtree(path, ignore_errors=True)
+
+            self.__clone(repo.url, path, timeout)
+            log.log_clone_created(repo.full_name, path)
+
+        return path
+
+    def head(self, path):
+        # Returns the sha of the commit checked out at 'path'.
+        return self.__git(["rev-parse", "HEAD"], path).strip()
+
+    def __clone(self, url, path, timeout):
+        # Clones next to the final path and renames it into place, so an interrupted clone never
+        # leaves a half-populated entry behind.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + ".partial"
+        shutil.rmtree(partial, ignore_errors=True)
+        try:
+            self.__git(["clone", "--depth", "1", "--filter=blob:none", "--single-branch", "--no-tags", "--quiet", url, partial], None, timeout)
+        except GitError:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(partial, path)
+
+    def __update(self, path, timeout):
+        self.__git(["fetch", "--depth", "1", "--no-tags", "--quiet", "origin", "HEAD"], path, timeout)
+        self.__git(["reset", "--hard", "--quiet", "FETCH_HEAD"], path, timeout)
+        self.__git(["clean", "-fdxq"], path, timeout)
+
+    def __git(self, arguments, cwd, timeout=None):
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        try:
+            result = subprocess.run(["git"] + arguments, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            raise GitError("git " + arguments[0] + " timed out after " + str(timeout) + " seconds")
+
+        if result.returncode != 0:
+            raise GitError("git " + arguments[0] + " failed: " + result.stderr.decode(errors="replace").strip())
+        return result.stdout.decode(errors="replace")
+
+    def __entry_lock(self, path):
+        with self.__lock:
+            if path not in self.__locks:
+                self.__locks[path] = EntryLock(path + ".lock")
+            return self.__locks[path]
+
+class EntryLock():
+    # A lock held by one thread of one process at a time: a threading lock combined with an
+    # exclusive flock on a lock file next to the entry.
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.__lock    = threading.Lock()
+        self.__file    = None
+
+    def __enter__(self):
+        self.__lock.acquire()
+        if fcntl is not None:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            self.__file = open(self.lock_path, "w")
+            fcntl.flock(self.__file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self.__file is not None:
+            fcntl.flock(self.__file, fcntl.LOCK_UN)
+            self.__file.close()
+            self.__file = None
+        self.__lock.release()
@@ -0,0 +1,65 @@
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+SCORING_DEADLINE = float(os.environ.get("SCORING_DEADLINE", 900)) # seconds allowed for one scoring run, 0 for no limit
+
+class DeadlineExceeded(Exception):
+    # Raised when work runs past its deadline.
+    pass
+
+class Deadline():
+    # The time by which a scoring run, or one step of it, has to finish. The deadline is handed
+    # down to everything the run waits on: pagination checks it between pages, and HTTP requests,
+    # git and semgrep get no more than the time that is left as their timeout. Wall-clock time is
+    # used so a deadline sent to a worker process means the same there. Deadline() never expires.
+
+    def __init__(self, seconds=None):
+        self.expires = None if seconds is None else time.time() + seconds
+
+    def remaining(self):
+        # Seconds left, or None for a deadline that never expires
+        return None if self.expires is None else max(0.0, self.expires - time.time())
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def check(self, what):
+        if self.expired():
+            raise DeadlineExceeded(what + " ran past its deadline")
+
+    def within(self, seconds):
+        # A deadline 'seconds' from now, or this one if it comes first. None seconds adds no limit.
+        child = Deadline(seconds)
+        if self.expires is not None and (child.expires is None or self.expires < child.expires):
+            child.expires = self.expires
+        return child
+
+    def timeout(self, limit=None):
+        # The timeout to give one blocking call: the time left, capped at 'limit'. Raises
+        # DeadlineExceeded if no time is left.
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        if remaining <= 0:
+            raise DeadlineExceeded("no time left before the deadline")
+        return remaining if limit is None else min(limit, remaining)
+
+def scoring_deadline(seconds=SCORING_DEADLINE):
+    # The deadline of a scoring run started now; 0 means no limit
+    return Deadline(seconds if seconds else None)
+
+def run_within(deadline, function, *args):
+    # Calls function(*args) on a thread of its own and waits for it until 'deadline', raising
+    # DeadlineExceeded if it has not returned by then. Threads cannot be stopped, so an overrunning
+    # call is abandoned; it ends once the deadline it was passed makes its own blocking calls fail.
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = executor.submit(function, *args)
+        try:
+            return future.result(timeout=deadline.remaining())
+        except TimeoutError:
+            raise DeadlineExceeded(getattr(function, "__qualname__", "call") + " ran past its deadline")
+    finally:
+        executor.shutdown(wait=False)
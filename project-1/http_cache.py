@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from github.Requester import Requester, HTTPRequestsConnectionClass, HTTPSRequestsConnectionClass
+
+CACHE_DIR       = os.environ.get("HTTP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ece461-http-cache"))
+CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+HTTP_POOL_SIZE  = int(os.environ.get("HTTP_POOL_SIZE", 32))   # keep-alive connections kept per host
+
+# Headers describing the original transfer, which no longer apply to a replayed body
+TRANSFER_HEADERS = ["Content-Encoding", "Content-Length", "Transfer-Encoding"]
+
+class HTTPCache():
+    # A disk-backed store of GET responses that carry an ETag or Last-Modified validator. Each
+    # entry is one JSON file named by the hash of the request's method, url and credentials.
+    # Entries are touched when replayed, and once the directory grows past 'max_bytes' the
+    # least recently used ones are deleted. Counters of hits (304 replays), misses, stores and
+    # evictions are kept for stats().
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__lock    = threading.Lock()
+        self.__counts  = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.__size = sum(size for _, size, _ in self.__entries())
+
+    def key(self, request):
+        # Different tokens may see different data, so the credentials are part of the key.
+        parts = [request.method, request.url, request.headers.get("Authorization", ""), request.headers.get("Accept", "")]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def load(self, key):
+        try:
+            with open(self.__path(key), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, response):
+        headers = {name: value for name, value in response.headers.items() if name not in TRANSFER_HEADERS}
+        entry   = {
+            "url"      : response.url,
+            "status"   : response.status_code,
+            "reason"   : response.reason,
+            "encoding" : response.encoding,
+            "headers"  : headers,
+            "body"     : response.content.decode("latin-1"),
+        }
+
+        path = self.__path(key)
+        temp = path + "." + str(threading.get_ident()) + ".tmp"
+        with open(temp, "w") as file:
+            json.dump(entry, file)
+        size = os.path.getsize(temp)
+        old  = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(temp, path)
+
+        with self.__lock:
+            self.__counts["stores"] += 1
+            self.__size += size - old
+            over = self.__size > self.max_bytes
+        if over:
+            self.__evict()
+
+    def replay(self, key, entry, request, not_modified):
+        # Builds a full response from a stored entry, refreshed with the headers of the 304.
+        headers = CaseInsensitiveDict(entry["headers"])
+        for name, value in not_modified.headers.items():
+            if name not in TRANSFER_HEADERS:
+                headers[name] = value
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason      = entry["reason"]
+        response.encoding    = entry["encoding"]
+        response.headers     = headers
+        response.url         = entry["url"]
+        response.request     = request
+        response.connection  = not_modified.connection
+        response._content    = entry["body"].encode("latin-1")
+
+        try:
+            os.utime(self.__path(key))
+        except OSError:
+            pass
+        return response
+
+    def count(self, name):
+        with self.__lock:
+            self.__counts[name] += 1
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats["bytes"] = self.__size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def __evict(self):
+        # Deletes least recently used entries until the cache is back under 90% of its limit.
+        entries = sorted(self.__entries(), key=lambda entry: entry[2])
+        total   = sum(size for _, size, _ in entries)
+        target  = self.max_bytes * 0.9
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total   -= size
+            evicted += 1
+
+        with self.__lock:
+            self.__size = total
+            self.__counts["evictions"] += evicted
+
+    def __entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+class CachingAdapter(HTTPAdapter):
+    # A requests transport adapter that revalidates cached GET responses. A stored ETag or
+    # Last-Modified is sent as If-None-Match / If-Modified-Since, and a 304 answer (which GitHub
+    # does not count against the rate limit) is replaced by the stored response.
+
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        key   = self.cache.key(request)
+        entry = self.cache.load(key)
+        if entry is not None:
+            headers = CaseInsensitiveDict(entry["headers"])
+            if "ETag" in headers:
+                request.headers["If-None-Match"] = headers["ETag"]
+            if "Last-Modified" in headers:
+                request.headers["If-Modified-Since"] = headers["Last-Modified"]
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.count("hits")
+            return self.cache.replay(key, entry, request, response)
+
+        self.cache.count("misses")
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            self.cache.store(key, response)
+        return response
+
+_cache   = None
+_session = None
+_lock    = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = HTTPCache()
+        return _cache
+
+def get_session():
+    # The session shared by every GitHub and npm request, with the caching adapter mounted. Its
+    # connection pool keeps up to HTTP_POOL_SIZE connections per host alive, enough for the
+    # concurrent fetches of several repositories.
+    global _session
+    cache = get_cache()
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount("https://", CachingAdapter(cache, pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+            _session.mount("http://", CachingAdapter(cache, pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+        return _session
+
+class CachedHTTPSConnection(HTTPSRequestsConnectionClass):
+    # PyGithub connection class that sends its requests through the shared caching session.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = get_session()
+
+def install():
+    # Routes every PyGithub request in this process through the cache.
+    Requester.injectConnectionClasses(HTTPRequestsConnectionClass, CachedHTTPSConnection)
+
+def stats():
+    return get_cache().stats()
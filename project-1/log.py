@@ -46,6 +46,10 @@ class Log():
         log = self.warning + "No license found for repository '" + repo.name + "'"
         self.__write_log_to_file(log)
 
+    def log_graphql_fallback(self, repo, error):
+        log = self.warning + "GraphQL fetch failed for repository '" + repo.full_name + "', using the REST API: " + str(error)
+        self.__write_log_to_file(log)
+
     def log_url_type(self, url, repo_type):
         log = self.debug + url + " is of type: " + repo_type
         self.__write_log_to_file(log)
@@ -91,6 +95,46 @@ class Log():
         log = self.debug + "semgrep test " + test_name + " found " + str(num_issues) + " issues with repository '" + repo_name + "'"
         self.__write_log_to_file(log)
 
+    def log_semgrep_cache_hit(self, repo_name, commit_sha):
+        log = self.debug + "semgrep results for repository '" + repo_name + "' at " + commit_sha + " found in cache"
+        self.__write_log_to_file(log)
+
+    def log_semgrep_scan(self, repo_name, num_targets, skipped, seconds):
+        log = self.trace + "semgrep scanned " + str(num_targets) + " files of repository '" + repo_name + "' in " + "%.1f" % seconds + "s, skipped: " + str(skipped)
+        self.__write_log_to_file(log)
+
+    def log_rule_pack_refreshed(self, config, sha256):
+        log = self.trace + "semgrep rule pack " + config + " fetched, sha256 " + sha256
+        self.__write_log_to_file(log)
+
+    def log_rule_pack_refresh_failed(self, config, error):
+        log = self.warning + "Could not fetch semgrep rule pack " + config + ": " + str(error)
+        self.__write_log_to_file(log)
+
+    def log_clone_created(self, full_name, path):
+        log = self.trace + "Repository '" + full_name + "' cloned to " + path
+        self.__write_log_to_file(log)
+
+    def log_clone_updated(self, full_name, path):
+        log = self.debug + "Repository '" + full_name + "' updated in " + path
+        self.__write_log_to_file(log)
+
+    def log_clone_failed(self, full_name, error):
+        log = self.warning + "Could not update clone of repository '" + full_name + "', cloning again: " + str(error)
+        self.__write_log_to_file(log)
+
+    def log_metric_overran(self, metric, repo, error):
+        log = self.warning + "Metric '" + metric.name + "' did not finish for repository '" + repo.name + "' in time, its score is imputed: " + str(error)
+        self.__write_log_to_file(log)
+
+    def log_fetch_overran(self, repo, fields, error):
+        log = self.warning + "Fetching " + ", ".join(fields) + " of repository '" + repo.full_name + "' ran past the deadline, the metrics needing it are imputed: " + str(error)
+        self.__write_log_to_file(log)
+
+    def log_early_exit(self, repo, lower, upper, skipped):
+        log = self.trace + "Scoring of repository '" + repo.name + "' stopped early with total between " + "%.3f" % lower + " and " + "%.3f" % upper + ", skipped: " + str(skipped)
+        self.__write_log_to_file(log)
+
     def __write_log_to_file(self, log):
         if self.log_level > 0 and (self.log_level == 2 or self.debug not in log):
             log = str(datetime.datetime.now()) + ": " + log + "\n"
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import atexit
+import tempfile
+import threading
+
+METRIC_COSTS_FILE  = os.path.abspath(os.environ.get("METRIC_COSTS_FILE", os.path.join(tempfile.gettempdir(), "ece461-metric-costs.json")))
+COST_SAVE_INTERVAL = float(os.environ.get("METRIC_COSTS_SAVE_INTERVAL", 300))   # seconds between writes of newly recorded costs
+COST_SMOOTHING     = 0.2                                                         # weight of the newest measurement in the moving average
+
+# Seconds per repository assumed for a metric that has never been timed. Metrics that only read
+# fetched data are nearly free, correctness clones the repository and runs semgrep.
+DEFAULT_COSTS = {
+    "LICENSE_SCORE"               : 0.001,
+    "DEPENDENCY_SCORE"            : 0.002,
+    "RAMP_UP_SCORE"               : 0.005,
+    "RESPONSIVE_MAINTAINER_SCORE" : 0.5,
+    "BUS_FACTOR_SCORE"            : 1.0,
+    "CORRECTNESS_SCORE"           : 60.0,
+}
+
+class MetricCosts():
+    # Keeps an exponential moving average of how many seconds each metric takes per repository,
+    # saved as JSON so the estimates survive restarts. Used to run the cheapest metrics first when
+    # scoring can stop early. Averages are kept in memory and written back at most every
+    # 'save_interval' seconds and when the process exits. Safe to use from several threads;
+    # separate processes sharing a file simply overwrite each other's averages.
+
+    def __init__(self, file_name=METRIC_COSTS_FILE, smoothing=COST_SMOOTHING, save_interval=COST_SAVE_INTERVAL):
+        self.file_name     = file_name
+        self.smoothing     = smoothing
+        self.save_interval = save_interval
+        self.__lock        = threading.Lock()
+        self.__costs       = self.__load()
+        self.__dirty       = False
+        self.__saved_at    = time.monotonic()
+        atexit.register(self.save)
+
+    def estimate(self, metric_name):
+        with self.__lock:
+            return self.__costs.get(metric_name, DEFAULT_COSTS.get(metric_name, 1.0))
+
+    def record(self, metric_name, seconds):
+        with self.__lock:
+            if metric_name in self.__costs:
+                self.__costs[metric_name] += self.smoothing * (seconds - self.__costs[metric_name])
+            else:
+                self.__costs[metric_name] = seconds
+            self.__dirty = True
+            due          = time.monotonic() - self.__saved_at >= self.save_interval
+
+        if due:
+            self.save()
+
+    def save(self):
+        # Writes the averages to 'file_name' if any were recorded since the last write
+        with self.__lock:
+            if not self.__dirty:
+                return
+            costs           = dict(self.__costs)
+            self.__dirty    = False
+            self.__saved_at = time.monotonic()
+
+        try:
+            temp = self.file_name + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            with open(temp, "w") as file:
+                json.dump(costs, file, indent=4, sort_keys=True)
+            os.replace(temp, self.file_name)
+        except OSError:
+            pass
+
+    def stats(self):
+        # Current estimate, in seconds, for every metric that has a default or has been timed
+        with self.__lock:
+            names = set(DEFAULT_COSTS) | set(self.__costs)
+            return {name: self.__costs.get(name, DEFAULT_COSTS.get(name)) for name in sorted(names)}
+
+    def __load(self):
+        try:
+            with open(self.file_name, "r") as file:
+                return {name: float(seconds) for name, seconds in json.load(file).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
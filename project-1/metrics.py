@@ -1,28 +1,72 @@
 import os
-import subprocess
-import json
 
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+from clone_cache import CloneCache
+from semgrep_scan import SemgrepScanner
+from semgrep_rules import RuleCache, read_configs
+from scan_scope import ScanScope
+from deadline import Deadline, DeadlineExceeded, run_within
 from log import log
 
+METRIC_BUDGET      = float(os.environ.get("METRIC_BUDGET", 120))      # seconds one metric may take per repository
+CORRECTNESS_BUDGET = float(os.environ.get("CORRECTNESS_BUDGET", 300)) # the same for the clone and semgrep scan
+
 class Metric(ABC):
     # Base class for all metric classes. The method calculate_scores() calculates the normalized
     # scores for each metric. The abstract class calculate_score() forces all derived metric 
-    # classes to provide functionality on how a metric score is calculated.
+    # classes to provide functionality on how a metric score is calculated. A metric may take at
+    # most 'budget' seconds per repository when scoring runs against a deadline. 'fields' names the
+    # Repository fields calculate_score() reads, so exactly those are fetched before it runs.
+
+    budget = METRIC_BUDGET
+    fields = ()
 
     def __init__(self, name, weight):
         self.name   = name
         self.weight = weight
 
-    def calculate_scores(self, repositories):
+    def calculate_scores(self, repositories, deadline=None):
         # Calculates the metric score for each repository. Returns a normalized list of these
-        # scores. 
+        # scores. With a deadline, a repository whose score could not be calculated in time
+        # gets None.
 
         scores = []
         for repo in repositories:
-            scores.append(self.calculate_score(repo))
-
+            if deadline is None:
+                scores.append(self.calculate_score(repo))
+            else:
+                scores.append(self.calculate_score_within(repo, deadline))
+
+        return self.normalize_available(scores, repositories)
+
+    def calculate_score_within(self, repo, deadline):
+        # The raw score of 'repo', or None if calculating it overran the metric's budget or the
+        # run's deadline. Other errors are raised as usual.
+        budget = deadline.within(self.budget)
+        try:
+            return run_within(budget, self.calculate_score, repo, budget)
+        except Exception as e:
+            if not isinstance(e, DeadlineExceeded) and not budget.expired():
+                raise
+            log.log_metric_overran(self, repo, e)
+            return None
+
+    def normalize_available(self, scores, repositories):
+        # normalize_scores() over the repositories that have a score; the others stay None.
+        available  = [i for i, score in enumerate(scores) if score is not None]
+        normalized = self.normalize_scores([scores[i] for i in available], [repositories[i] for i in available])
+
+        result = [None] * len(scores)
+        for i, score in zip(available, normalized):
+            result[i] = score
+        return result
+
+    def normalize_scores(self, scores, repositories):
+        # Scales a list of raw scores, one per repository, so that the best repository gets 1 and
+        # the worst gets 0. A single repository always gets 1.
+
+        scores = list(scores)
         log.log_metric_subscores_calculated(self, scores, repositories)
 
         if len(scores) == 0:
@@ -40,14 +84,16 @@ class Metric(ABC):
         return scores
 
     @abstractmethod
-    def calculate_score(self, repo):
+    def calculate_score(self, repo, deadline=None):
         pass
 
 class RampUpMetric(Metric):
     # "Ramp Up" measures how long it takes for developers to start using a package. We look at the
     # length of the README file to determine how much documentation is available to developers.
 
-    def calculate_score(self, repo):
+    fields = ("read_me",)
+
+    def calculate_score(self, repo, deadline=None):
         read_me_size = len(repo.read_me.split("\n"))
 
         log.log_subscore_calculated(repo, read_me_size, self)
@@ -57,49 +103,46 @@ class CorrectnessMetric(Metric):
     # "Correctness" measures how the repository's standard of correctness. Here we perform static 
     # analysis of the repository with semgrep. Runs a series of tests (found in a "semgrep.txt"
     # file) and keeps track of the number of issues that appear. As we want a repository to have
-    # the minimal number of issues, we return a negated issue count. 
+    # the minimal number of issues, we return a negated issue count. All tests run in one semgrep
+    # process, and the counts are cached per commit.
+
+    budget       = CORRECTNESS_BUDGET
+    clone_cache  = CloneCache()
+    rule_cache   = RuleCache()
+    scan_scope   = ScanScope()
+    semgrep_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "semgrep.txt")
+    __scanner    = None
 
-    directory = "repositories"
+    def calculate_score(self, repo, deadline=None):
+        deadline = deadline or Deadline()
+        path     = self.clone_cache.checkout(repo, deadline.timeout())
 
-    def calculate_score(self, repo):
-        path = self.__download_repository_to_local(repo)
+        counts = self.scanner().scan(path, self.clone_cache.head(path), deadline)
 
-        num_issues = 0 
-        with open("project-1/semgrep.txt", "r") as filePtr:
-            for line in filePtr.readlines():
-                if line.endswith("\n"):
-                    line = line[:-1]
-                num_issues += self.__run_test(line, path)
+        num_issues = 0
+        for test_name, test_issues in counts.items():
+            log.log_semgrep_test_results(repo.name, test_name, test_issues)
+            num_issues += test_issues
 
         score = -num_issues
         log.log_subscore_calculated(repo, score, self)
         return score
 
-    def __download_repository_to_local(self, repo):
-        path          = self.directory + "/" + repo.name
-        clone_command = "git clone " + repo.url + " " + path
-
-        if not os.path.exists(path):
-            os.system(clone_command)
-
-        return path
-
-    def __run_test(self, test_name, repository_path):
-        output = subprocess.Popen(["semgrep", "--config", test_name, "--json", '-q', repository_path], shell=False, stdout=subprocess.PIPE)
-        output.wait()
-
-        line   = output.stdout.readline()
-        object = json.loads(line)
-
-        num_issues = len(object['results'])
-        log.log_semgrep_test_results(repository_path.split("/")[1], test_name, num_issues)
-        return num_issues
+    def scanner(self):
+        # The semgrep scanner for the tests in semgrep.txt, with registry packs taken from the
+        # local rule cache and the scan limited to the repository's own JavaScript sources. Built once
+        # per process, so every scan uses the rule files resolved at startup, see proj1.RULESET_VERSION.
+        if CorrectnessMetric.__scanner is None:
+            CorrectnessMetric.__scanner = SemgrepScanner(read_configs(self.semgrep_file), rules=self.rule_cache, scope=self.scan_scope)
+        return CorrectnessMetric.__scanner
 
 class BusFactorMetric(Metric):
     # "Bus factor" measures how many developers are contributing to a package. We look at how many
     # unique developers made a contribution (commit) to the source code within the past year. 
 
-    def calculate_score(self, repo):
+    fields = ("commits",)
+
+    def calculate_score(self, repo, deadline=None):
         contributors = {}
         for commit in repo.commits:
             if commit.author not in contributors:
@@ -117,7 +160,9 @@ class ResponsivenessMetric(Metric):
     # use the average time that currently opened issues have been open for and the number of dependencies
     # that the repository has. The average time is measured in days. 
 
-    def calculate_score(self, repo):
+    fields = ("open_issues", "num_dependencies")
+
+    def calculate_score(self, repo, deadline=None):
         ave_time_issue_is_open = self.__get_ave_time_issue_is_open(repo)
         num_dependencies       = self.__get_num_dependencies(repo)
         score = -(ave_time_issue_is_open + (num_dependencies))
@@ -139,7 +184,9 @@ class ResponsivenessMetric(Metric):
 class LicenseMetric(Metric):
     # We test to see if a repository is compatable with the 'lgpl-2.1'.
 
-    def calculate_score(self, repo):
+    fields = ("license_name",)
+
+    def calculate_score(self, repo, deadline=None):
         score = 1 if repo.license_name in ['MIT', 'lgpl-2.1'] else 0
         
         log.log_subscore_calculated(repo, score, self)
@@ -147,7 +194,9 @@ class LicenseMetric(Metric):
 
     
 class DependencyMetric(Metric):
-    def calculate_score(self, repo):
+    fields = ("num_dependencies",)
+
+    def calculate_score(self, repo, deadline=None):
         num_dependencies       = self.__get_num_dependencies(repo)
         if num_dependencies == 0:
             score = 1.0
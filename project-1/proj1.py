@@ -1,13 +1,24 @@
 import json
 import sys
 import os
+import argparse
+import time
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError, as_completed
 from flask.json.tag import JSONTag
 
 from github import Github
 
-from repository import Repository
+from repository import Repository, RepositoryLocation, resolve_github_url
+from github_graphql import GitHubGraphQL
+import http_cache
 from metrics import LicenseMetric, RampUpMetric, CorrectnessMetric, BusFactorMetric, ResponsivenessMetric, DependencyMetric
 from score import Ranking 
+from metric_costs import MetricCosts
+from deadline import DeadlineExceeded, SCORING_DEADLINE, scoring_deadline
+from scan_scope import SEMGREP_JOBS
 from log import log
 
 def clear_log_file():
@@ -15,25 +26,79 @@ def clear_log_file():
     with open(log_file, "w") as file:
         file.write("")
 
-def create_list_of_repositories(file_name, github):
-    # Accepts the file name that contains a list of repository urls. Creates a list of Repository 
-    # objects from these urls and returns this list. 
+def create_github(token):
+    # Creates the github object used for the REST API, with its requests going through the
+    # on-disk HTTP cache.
+    http_cache.install()
+    return Github(token)
+
+def create_graphql_client(token):
+    # Repositories are fetched through the GraphQL API unless GITHUB_GRAPHQL is set to 0, in which
+    # case only the REST API is used.
+    if os.environ.get("GITHUB_GRAPHQL", "1") == "0":
+        return None
+    return GitHubGraphQL(token)
+
+def create_repositories(urls, github, graphql=None, deadline=None, fields=()):
+    # Accepts a list of repository urls. Creates a list of Repository objects from these urls and
+    # returns this list. The given repository fields are fetched up front, see required_fields.
 
     repositories = []
+    for url in urls:
+        repositories.append(Repository(url, github, graphql, deadline, fields))
+
+    log.log_repo_list_created(repositories)
+    return repositories
+
+def read_urls(file_name):
+    # Returns the list of repository urls in the given file, one per line.
+
+    urls = []
     with open(file_name, "r") as file:
         log.log_url_file_read(file_name)
         for line in file.readlines():
             if line[-1] == "\n":
                 line = line[:-1]
             print(line)
-
-            repo = Repository(line, github)
-            repositories.append(repo)
+            urls.append(line)
 
     log.log_url_file_closed(file_name)
-    log.log_repo_list_created(repositories)
 
-    return repositories
+    return urls
+
+def create_list_of_repositories(file_name, github, graphql=None, deadline=None, fields=()):
+    # Accepts the file name that contains a list of repository urls. Creates a list of Repository 
+    # objects from these urls and returns this list. 
+
+    return create_repositories(read_urls(file_name), github, graphql, deadline, fields)
+
+# Stored scores are only reused while this matches. Change it whenever a metric or weight changes.
+METRICS_VERSION = "1"
+
+def create_metrics():
+    # Returns a fresh list of the metrics used to score a repository. Metric objects are created per
+    # call so that concurrent scoring runs never share state.
+    metrics = [
+        RampUpMetric        ("RAMP_UP_SCORE"              , .2),
+        CorrectnessMetric   ("CORRECTNESS_SCORE"          , .2),
+        BusFactorMetric     ("BUS_FACTOR_SCORE"           , .3),
+        ResponsivenessMetric("RESPONSIVE_MAINTAINER_SCORE", .1),
+        LicenseMetric       ("LICENSE_SCORE"              , .1), 
+        DependencyMetric    ("DEPENDENCY_SCORE"           , .2)
+    ]
+    log.log_metrics_created(metrics)
+
+    return metrics
+
+def required_fields(metrics):
+    # The Repository fields read by any of 'metrics', fetched together before the metrics run
+    return [field for field in Repository.FIELDS if any(field in metric.fields for metric in metrics)]
+
+# Keys of the score dictionary for the metrics of create_metrics(), in the same order
+SCORE_NAMES = ['ramp_up', 'correctness', 'bus_factor', 'responsiveness', 'license', 'dependency']
+
+# Seconds each metric has taken per repository in past runs, see evaluate_metrics_early
+metric_costs = MetricCosts()
 
 def print_results(metrics, rankings):
     # Prints out the metric names, repository urls, repository total scores, and repository sub 
@@ -53,11 +118,16 @@ def print_results(metrics, rankings):
 
     return output_string
 
-def find_rankings(metrics, repositories):
-    for metric in metrics:
-        sub_scores = metric.calculate_scores(repositories)
-        for i, sub_score in enumerate(sub_scores):
-            repositories[i].scores.append(sub_score)
+def find_rankings(metrics, repositories, deadline=None, costs=None):
+    # With a deadline, each metric gets at most its budget per repository. A sub-score that is not
+    # ready in time is imputed as 0, the worst normalized score, and recorded in the repository's
+    # 'imputed' list. Given a MetricCosts, the seconds each metric took per repository are recorded.
+    for j, metric in enumerate(metrics):
+        start      = time.monotonic()
+        sub_scores = metric.calculate_scores(repositories, deadline)
+        if repositories and costs is not None:
+            costs.record(metric.name, (time.monotonic() - start) / len(repositories))
+        append_sub_scores(repositories, j, sub_scores)
 
     rankingObject = Ranking(metrics)
     rankings      = rankingObject.get_rankings(repositories)
@@ -65,6 +135,110 @@ def find_rankings(metrics, repositories):
     log.log_final_rankings(rankings)
     return rankings
 
+def append_sub_scores(repositories, j, sub_scores):
+    # Appends metric j's normalized sub-scores to the repositories, imputing 0 for a missing one
+    for i, sub_score in enumerate(sub_scores):
+        if sub_score is None:
+            repositories[i].imputed.append(j)
+            sub_score = 0.0
+        repositories[i].scores.append(sub_score)
+
+class NDJSONWriter():
+    # Writes one JSON object per line to a file (or stdout for "-") and flushes after each line, so
+    # results can be read while scoring is still running. Safe to use from several threads.
+
+    def __init__(self, file_name):
+        self.file   = sys.stdout if file_name == "-" else open(file_name, "w")
+        self.__lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self.__lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+def calculate_raw_scores(url, github, graphql, metrics, process_pool, deadline):
+    # Fetches one repository and returns it with its raw (not yet normalized) sub-scores, in the
+    # order of 'metrics'. CorrectnessMetric clones the repository and runs semgrep, so it is sent
+    # to the process pool while the other metrics, which only read fetched data, run here. A
+    # metric that overruns its budget or the deadline gets None.
+    repo = Repository(url, github, graphql, deadline, required_fields(metrics))
+
+    futures = {}
+    scores  = {}
+    for i, metric in enumerate(metrics):
+        if isinstance(metric, CorrectnessMetric):
+            budget     = deadline.within(metric.budget)
+            futures[i] = (process_pool.submit(metric.calculate_score, RepositoryLocation(repo), budget), budget)
+        else:
+            scores[i] = metric.calculate_score_within(repo, deadline)
+
+    for i, (future, budget) in futures.items():
+        try:
+            scores[i] = future.result(timeout=budget.remaining())
+        except Exception as e:
+            if not isinstance(e, (TimeoutError, DeadlineExceeded)) and not budget.expired():
+                raise
+            log.log_metric_overran(metrics[i], repo, e)
+            scores[i] = None
+
+    return repo, [scores[i] for i in range(len(metrics))]
+
+def share_semgrep_jobs(processes):
+    # Process pool initializer: the semgrep processes running at once share SEMGREP_JOBS between them
+    CorrectnessMetric.scan_scope.jobs = max(1, SEMGREP_JOBS // processes)
+
+def find_rankings_concurrently(urls, github, graphql, metrics, jobs, writer, deadline):
+    # Scores up to 'jobs' repositories at a time: fetching runs on a thread pool and semgrep on a
+    # process pool. Each repository's raw sub-scores are written as soon as they are known. Once
+    # every repository is done, the scores are normalized across all of them and ranked, and the
+    # final scores are written. A repository that fails is reported and left out of the ranking.
+    # Work reaches the process pool from the thread pool's threads, so its workers are spawned
+    # rather than forked: a fork could copy a lock another thread holds (logging, the HTTP cache).
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn"), initializer=share_semgrep_jobs, initargs=(jobs,)) as process_pool, ThreadPoolExecutor(max_workers=jobs) as thread_pool:
+        futures = {}
+        for i, url in enumerate(urls):
+            futures[thread_pool.submit(calculate_raw_scores, url, github, graphql, metrics, process_pool, deadline)] = (i, url)
+
+        for future in as_completed(futures):
+            i, url = futures[future]
+            try:
+                repo, raw_scores = future.result()
+            except Exception as e:
+                traceback.print_exc()
+                writer.write({"type": "error", "url": url, "error": str(e)})
+                continue
+
+            results[i] = (repo, raw_scores)
+            writer.write({
+                "type"   : "raw",
+                "url"    : repo.url,
+                "name"   : repo.full_name,
+                "scores" : {metric.name: raw_scores[j] for j, metric in enumerate(metrics)},
+            })
+
+    repositories = [results[i][0] for i in sorted(results)]
+    raw_scores   = [results[i][1] for i in sorted(results)]
+    log.log_repo_list_created(repositories)
+
+    for j, metric in enumerate(metrics):
+        append_sub_scores(repositories, j, metric.normalize_available([scores[j] for scores in raw_scores], repositories))
+
+    rankings = Ranking(metrics).get_rankings(repositories) if repositories else []
+    log.log_final_rankings(rankings)
+
+    for ranking in rankings:
+        record = {"type": "final", "url": ranking.repository.url, "name": ranking.repository.full_name}
+        record.update(ranking_dict(ranking))
+        writer.write(record)
+
+    return rankings
+
 def ranking_dict(repo):
 
     rankings = {'ramp_up' : repo.repository.scores[0] * (0.2), 
@@ -78,34 +252,152 @@ def ranking_dict(repo):
     final_score = sum(values)
     
     rankings['score'] = final_score
+    if repo.repository.imputed:
+        rankings['imputed'] = [SCORE_NAMES[j] for j in repo.repository.imputed]
     print(rankings)
     return rankings
 
+def ruleset_version():
+    # The version of the semgrep rule set CorrectnessMetric scans with, taken once when the process
+    # starts from the scanner every CorrectnessMetric then shares. See the rule cache's manifest.json for the rule packs
+    # behind each version.
+    return RULESET_VERSION
 
-    
+RULESET_VERSION = CorrectnessMetric("CORRECTNESS_SCORE", .2).scanner().ruleset_version()
+
+def score_urls(urls, github=None, deadline=None):
+    # Scores a list of repository urls together and returns one score dictionary per url, in the
+    # same order as 'urls'. Scores are normalized across the given urls, exactly as when they are
+    # listed in one input file. Each dictionary also names the semgrep rule-set version used and,
+    # under 'imputed', any sub-score that was not ready by the deadline (SCORING_DEADLINE seconds
+    # by default). Nothing is read from or written to shared files, so this can be called from
+    # several threads at once.
+    token = os.environ["GITHUB_TOKEN"]
+    if github is None:
+        github = create_github(token)
+    if deadline is None:
+        deadline = scoring_deadline()
+
+    metrics      = create_metrics()
+    repositories = create_repositories(urls, github, create_graphql_client(token), deadline, required_fields(metrics))
+    rankings     = find_rankings(metrics, repositories, deadline, metric_costs)
+
+    ruleset = ruleset_version()
+    scores  = {}
+    for ranking in rankings:
+        scores[id(ranking.repository)] = ranking_dict(ranking)
+        scores[id(ranking.repository)]['ruleset'] = ruleset
+
+    return [scores[id(repo)] for repo in repositories]
+
+def score_url(url, github=None, deadline=None):
+    # Scores a single repository url and returns its score dictionary.
+    return score_urls([url], github, deadline)[0]
+
+def evaluate_metrics_early(repo, metrics, threshold, costs, deadline=None):
+    # Runs the metrics on a single repository, cheapest first by the seconds recorded in 'costs', and
+    # stops as soon as the weighted total is certain to end above 'threshold' or certain to end at or
+    # below it. A normalized score lies between 0 and 1, so a metric that has not run adds between 0
+    # and its weight. Returns the weighted sub-scores in the order of 'metrics', with None for every
+    # metric that was skipped, and the lower and upper bounds on the total. With a deadline, a metric
+    # that overruns its budget is imputed as 0 and recorded in the repository's 'imputed' list. Each
+    # metric's repository fields are fetched just before it runs, so a skipped metric's never are,
+    # and the time spent fetching counts towards the metric's cost. A field not fetched by the
+    # deadline makes the metrics reading it overrun, so they are imputed too.
+    weighted = [None] * len(metrics)
+    lower    = 0.0
+    upper    = sum(metric.weight for metric in metrics)
+    order    = sorted(range(len(metrics)), key=lambda i: (costs.estimate(metrics[i].name), -metrics[i].weight))
+
+    for i in order:
+        if lower > threshold or upper <= threshold:
+            break
+        start = time.monotonic()
+        repo.fetch(metrics[i].fields)
+        raw   = metrics[i].calculate_score(repo) if deadline is None else metrics[i].calculate_score_within(repo, deadline)
+        costs.record(metrics[i].name, time.monotonic() - start)
+
+        if raw is None:
+            repo.imputed.append(i)
+            weighted[i] = 0.0
+        else:
+            weighted[i] = metrics[i].normalize_scores([raw], [repo])[0] * metrics[i].weight
+        lower      += weighted[i]
+        upper      -= metrics[i].weight - weighted[i]
+
+    skipped = [metrics[i].name for i in range(len(metrics)) if weighted[i] is None]
+    if skipped:
+        log.log_early_exit(repo, lower, upper, skipped)
+    return weighted, lower, upper
+
+def score_url_early(url, threshold, github=None, deadline=None):
+    # Scores a single repository url only as far as needed to tell whether its total score is above
+    # 'threshold'. Returns a score dictionary like score_url's in which skipped metrics are None,
+    # 'score' is the lowest total still possible and 'skipped' lists the keys left out. With no
+    # metric skipped the dictionary is the one score_url returns.
+    token = os.environ["GITHUB_TOKEN"]
+    if github is None:
+        github = create_github(token)
+    if deadline is None:
+        deadline = scoring_deadline()
+
+    repo = Repository(url, github, create_graphql_client(token), deadline)
+    weighted, lower, upper = evaluate_metrics_early(repo, create_metrics(), threshold, metric_costs, deadline)
+
+    scores            = dict(zip(SCORE_NAMES, weighted))
+    scores['score']   = lower
+    scores['ruleset'] = ruleset_version()
+    skipped           = [name for name in SCORE_NAMES if scores[name] is None]
+    if skipped:
+        scores['skipped'] = skipped
+    if repo.imputed:
+        scores['imputed'] = [SCORE_NAMES[i] for i in repo.imputed]
+    return scores
+
+def resolve_repository(url, github=None):
+    # Returns the "owner/name" of the github repository behind a github or npm url and the sha
+    # of its default branch HEAD. Together with METRICS_VERSION this identifies a score.
+    if github is None:
+        github = create_github(os.environ["GITHUB_TOKEN"])
+
+    _, full_name = resolve_github_url(url)
+    repo         = github.get_repo(full_name)
+    head         = repo.get_branch(repo.default_branch)
+    return repo.full_name, head.commit.sha
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Scores and ranks the repositories listed in a file.")
+    parser.add_argument("url_file", help="file with one github or npm url per line")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="number of repositories to score at once (default: 1)")
+    parser.add_argument("--output", "-o", default="scores.ndjson", help="where --jobs writes per-repository NDJSON results, '-' for stdout")
+    parser.add_argument("--record-costs", action="store_true", help="add the seconds each metric takes to the metric cost estimates")
+    parser.add_argument("--deadline", type=float, default=SCORING_DEADLINE, help="seconds allowed for the whole run, 0 for no limit (default: %(default)s)")
+    return parser.parse_args(args)
 
 def main(args):
     # Creates a github object used for interacting with GitHub. Creates a list of repositories
     # that will be analyzed, and a list of metrics that will be used to calculate the score. 
     # Iterates through each metric to calculate each sub score for each repository. Ranks the 
-    # repositories based on the total score.
+    # repositories based on the total score. With --jobs N, repositories are scored N at a time
+    # and streamed to the --output file as they finish.
     clear_log_file()
+    options = parse_args(args)
 
-    token  = os.environ["GITHUB_TOKEN"]
-    github = Github(token)
-
-    repositories = create_list_of_repositories(args[0], github)
-    metrics      = [
-        RampUpMetric        ("RAMP_UP_SCORE"              , .2),
-        CorrectnessMetric   ("CORRECTNESS_SCORE"          , .2),
-        BusFactorMetric     ("BUS_FACTOR_SCORE"           , .3),
-        ResponsivenessMetric("RESPONSIVE_MAINTAINER_SCORE", .1),
-        LicenseMetric       ("LICENSE_SCORE"              , .1), 
-        DependencyMetric    ("DEPENDENCY_SCORE"           , .2)
-    ]
-    log.log_metrics_created(metrics)
+    token   = os.environ["GITHUB_TOKEN"]
+    github  = create_github(token)
+    graphql = create_graphql_client(token)
+    metrics  = create_metrics()
+    deadline = scoring_deadline(options.deadline)
 
-    rankings      = find_rankings(metrics, repositories)
+    if options.jobs > 1:
+        writer = NDJSONWriter(options.output)
+        try:
+            rankings = find_rankings_concurrently(read_urls(options.url_file), github, graphql, metrics, options.jobs, writer, deadline)
+        finally:
+            writer.close()
+    else:
+        repositories = create_list_of_repositories(options.url_file, github, graphql, deadline, required_fields(metrics))
+        rankings     = find_rankings(metrics, repositories, deadline, metric_costs if options.record_costs else None)
     
     with open('dict.txt','w') as dict_file:
         for repo_scores in rankings:
@@ -1,13 +1,20 @@
 import requests
 import os
 import re
+import threading
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.parse import urlparse
 from github import Github
 
+from github_graphql import GraphQLError
+from http_cache import get_session
+from deadline import Deadline, DeadlineExceeded
 from log import log
 
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", 8)) # fields of one repository fetched at once over the REST API
+
 class Issue():
     def __init__(self, title, created_at, closed_at):
         self.title      = title
@@ -18,64 +25,204 @@ class Commit():
     def __init__(self, author):
         self.author = author
 
+def resolve_github_url(url):
+    # Accepts a github or npm url and returns the github repository url together with its
+    # "owner/name". npm urls are resolved through the npm registry.
+    url_components = urlparse(url)
+    repo_url       = ""
+    # print(url)
+    if 'github' in url_components[1]:           
+        log.log_url_type(url, "github")
+        repo_url = url
+    else:
+        log.log_url_type(url, "npm")
+        
+        package_name = urlparse(url)[2].split('/package/')[1]
+        url          = "https://registry.npmjs.org/{}".format(package_name)
+        response     = get_session().get(url).json()
+        repo_url     = response['repository']['url'].strip('git+')[:-1]
+
+    url_components = urlparse(repo_url)
+    return repo_url, url_components[2][1:]
+
+def pipelined(paginated, per_page, deadline, what):
+    # Iterates over a PyGithub PaginatedList, requesting page N+1 while the items of page N are
+    # being processed instead of only once they run out. A page shorter than 'per_page' is the
+    # last one. Raises DeadlineExceeded before requesting a page past 'deadline'.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page   = 0
+        future = executor.submit(paginated.get_page, page)
+        while future is not None:
+            items  = future.result()
+            page  += 1
+            future = None
+            if len(items) >= per_page:
+                deadline.check(what)
+                future = executor.submit(paginated.get_page, page)
+            for item in items:
+                yield item
+
+class RepositoryLocation():
+    # The part of a Repository that is needed to clone it. Unlike a Repository it holds no github
+    # object, so it can be sent to a worker process.
+
+    def __init__(self, repo):
+        self.name      = repo.name
+        self.full_name = repo.full_name
+        self.url       = repo.url
+
 class Repository():
-    # A class that, when initialzed, fetches all needed data from the github repository.
-    # Accepts a url and a github object. The github object is used to interact with the
-    # github REST API. The url could either be a github url or an npm url. If it is an 
-    # npm url, it is converted into a github url. Also contains a list of sub-scores that
-    # have been calculated for this repository. 
-
-    def __init__(self, url, github):
-        self.github = github
-        print("URL: " + url)
-        self.__set_github_repo(url)
+    # A class that fetches the data the metrics need from the github repository. Accepts a url
+    # and a github object. The github object is used to interact with the github REST API. The
+    # url could either be a github url or an npm url. If it is an npm url, it is converted into a
+    # github url. Also contains a list of sub-scores that have been calculated for this repository.
+    # Each of FIELDS is fetched on first access, or up front for the 'fields' given, so data no
+    # metric reads is never fetched. If a GitHubGraphQL client is given, fields are fetched with
+    # GraphQL queries asking for just those fields, falling back to the REST API on failure.
+    # A field still being fetched at 'deadline' is left unfetched, and reading it raises
+    # DeadlineExceeded, so a metric that needs it is imputed instead of the whole run failing.
+
+    FIELDS = ("num_stars", "num_pull_requests", "num_forks", "open_issues", "commits", "read_me", "num_dependencies", "license_name")
 
-        self.num_stars         = self.__fetch_num_stars()
-        self.num_pull_requests = self.__fetch_num_pull_requests()
-        self.num_forks         = self.__fetch_num_forks()
-        self.open_issues       = self.__fetch_open_issues()
-        self.commits           = self.__get_commits()
-        self.read_me           = self.__get_read_me_file()
-        self.num_dependencies  = self.__get_num_dependencies()
-        self.license_name      = self.__get_license()
+    def __init__(self, url, github, graphql=None, deadline=None, fields=()):
+        self.github   = github
+        self.graphql  = graphql
+        self.deadline = deadline or Deadline()
+        self.repo     = None
+        self.__lock   = threading.RLock()
+        print("URL: " + url)
+        self.__resolve_url(url)
 
-        self.scores = []
+        self.scores  = []
+        self.imputed = [] # indices of the metrics whose score had to be imputed
 
+        self.fetch(fields)
         log.log_repository_created(self)
 
-    def __set_github_repo(self, url):
-        url_components = urlparse(url)
-        repo_url       = ""
-        # print(url)
-        if 'github' in url_components[1]:           
-            log.log_url_type(url, "github")
-            repo_url = url
-        else:
-            log.log_url_type(url, "npm")
-            
-            package_name = urlparse(url)[2].split('/package/')[1]
-            url          = "https://registry.npmjs.org/{}".format(package_name)
-            response     = requests.get(url).json()
-            repo_url     = response['repository']['url'].strip('git+')[:-1]
-
-        url_components = urlparse(repo_url)
-        self.repo      = self.github.get_repo(url_components[2][1:])
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, which for FIELDS means not fetched yet
+        if name not in Repository.FIELDS:
+            raise AttributeError(name)
+        self.fetch([name])
+        if name not in self.__dict__:
+            raise DeadlineExceeded("Fetching " + name + " ran past its deadline")
+        return self.__dict__[name]
+
+    def fetch(self, fields):
+        # Fetches those of 'fields' that have not been fetched yet: with one GraphQL query when
+        # possible, otherwise each from its REST endpoint, concurrently.
+        with self.__lock:
+            missing = [field for field in Repository.FIELDS if field in fields and field not in self.__dict__]
+            if not missing:
+                return
+            try:
+                if self.graphql is None or not self.__fetch_with_graphql(missing):
+                    self.__fetch_with_rest(missing)
+            except DeadlineExceeded as e:
+                log.log_fetch_overran(self, [field for field in missing if field not in self.__dict__], e)
+
+    def __resolve_url(self, url):
+        self.url, self.full_name = resolve_github_url(url)
+        self.name                = self.full_name.split('/')[-1]
+
+    def __set_github_repo(self):
+        if self.repo is not None:
+            return
+        self.repo      = self.github.get_repo(self.full_name)
         self.name      = self.repo.name
-        self.url       = repo_url
+        self.full_name = self.repo.full_name
+
+    def __fetch_with_rest(self, fields):
+        self.__set_github_repo()
+        loaders = {
+            "num_stars"         : self.__fetch_num_stars,
+            "num_pull_requests" : self.__fetch_num_pull_requests,
+            "num_forks"         : self.__fetch_num_forks,
+            "open_issues"       : self.__fetch_open_issues,
+            "commits"           : self.__get_commits,
+            "read_me"           : self.__get_read_me_file,
+            "num_dependencies"  : self.__get_num_dependencies,
+            "license_name"      : self.__get_license,
+        }
+
+        if len(fields) == 1:
+            self.__fetch_field(fields[0], loaders[fields[0]])
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(fields), FETCH_WORKERS)) as executor:
+                futures = [executor.submit(self.__fetch_field, field, loaders[field]) for field in fields]
+                for future in futures:
+                    future.result()
+
+    def __fetch_field(self, field, loader):
+        # Sets one field from its REST loader. A field not fetched by the deadline is left unset.
+        try:
+            self.deadline.check("Fetching " + field)
+            value = loader()
+        except DeadlineExceeded as e:
+            log.log_fetch_overran(self, [field], e)
+            return
+        setattr(self, field, value)
+
+    def __fetch_with_graphql(self, fields):
+        owner, name = self.full_name.split('/')[:2]
+        try:
+            data = self.graphql.fetch_repository(owner, name, datetime.utcnow() - timedelta(days=365), self.deadline, fields)
+        except (GraphQLError, requests.RequestException, KeyError, TypeError) as e:
+            log.log_graphql_fallback(self, e)
+            return False
+
+        self.name      = data["name"]
+        self.full_name = data["full_name"]
+
+        if "num_stars" in data:
+            self.num_stars         = data["num_stars"]
+        if "num_pull_requests" in data:
+            self.num_pull_requests = data["num_pull_requests"]
+        if "num_forks" in data:
+            self.num_forks         = data["num_forks"]
+        if "open_issues" in data:
+            self.open_issues       = [Issue(title, created_at, None) for title, created_at in data["open_issues"]]
+        if "commit_authors" in data:
+            self.commits           = [Commit(author) for author in data["commit_authors"]]
+
+        if "read_me" in data:
+            if data["read_me"] is None:
+                self.__set_github_repo()
+                self.read_me = self.__get_read_me_file()
+            else:
+                self.read_me = data["read_me"]
+
+        if "package_json" in data:
+            if data["package_json"] is None:
+                log.log_no_dependencies(self)
+                self.num_dependencies = 0
+            else:
+                self.num_dependencies = self.__count_dependencies(data["package_json"])
+
+        if "license_name" in data:
+            self.license_name = data["license_name"]
+            if data["license_name"] is None:
+                log.log_no_license(self)
+
+        return True
 
     def __fetch_num_stars(self):
         return self.repo.stargazers_count
 
     def __fetch_num_pull_requests(self):
-        pull_requests = self.repo.get_pulls()   
-        return len(list(pull_requests))
+        num_pull_requests = 0
+        for pull_request in pipelined(self.repo.get_pulls(), self.github.per_page, self.deadline, "Fetching pull requests"):
+            self.deadline.check("Fetching pull requests")
+            num_pull_requests += 1
+        return num_pull_requests
         
     def __fetch_num_forks(self):
         return self.repo.forks_count
 
     def __fetch_open_issues(self):
         open_issues = []
-        for issue in self.repo.get_issues(state='open'):
+        for issue in pipelined(self.repo.get_issues(state='open'), self.github.per_page, self.deadline, "Fetching open issues"):
+            self.deadline.check("Fetching open issues")
             open_issues.append(Issue(issue.title, issue.created_at, None))
 
         return open_issues
@@ -84,7 +231,8 @@ class Repository():
         commits   = []
         dateStart = datetime.now() - timedelta(days=365)
 
-        for commit in self.repo.get_commits(since=dateStart):
+        for commit in pipelined(self.repo.get_commits(since=dateStart), self.github.per_page, self.deadline, "Fetching commits"):
+            self.deadline.check("Fetching commits")
             if commit.author is not None:
                 commits.append(Commit(commit.author.node_id))
 
@@ -95,7 +243,9 @@ class Repository():
 
     def __get_num_dependencies(self):
         package_json   = self.repo.get_contents("package.json")
-        text           = str(package_json.decoded_content)
+        return self.__count_dependencies(str(package_json.decoded_content))
+
+    def __count_dependencies(self, text):
         results        = re.search('"dependencies": {[^}]*', text)
 
         if results == None:
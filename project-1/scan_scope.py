@@ -0,0 +1,87 @@
+import os
+import fnmatch
+import hashlib
+
+SCAN_EXTENSIONS     = (".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx")
+SCAN_EXCLUDE        = [
+    ".git", "node_modules", "bower_components", "vendor", "dist", "build", "coverage",
+    "fixtures", "__fixtures__", "docs", "doc", "*.min.js", "*.bundle.js", "*-min.js",
+]
+SCAN_MAX_FILE_BYTES = int(os.environ.get("SCAN_MAX_FILE_BYTES", 256 * 1024))
+SEMGREP_TIMEOUT     = int(os.environ.get("SEMGREP_TIMEOUT", 10))        # seconds per rule per file
+SEMGREP_MAX_MEMORY  = int(os.environ.get("SEMGREP_MAX_MEMORY", 2000))   # MB
+SEMGREP_JOBS        = int(os.environ.get("SEMGREP_JOBS", os.cpu_count() or 1))   # split between the processes of proj1 --jobs
+
+# A line this long in the first bytes of a file means it was minified or generated
+MINIFIED_LINE_LENGTH = 1000
+
+class ScanScope():
+    # Decides which files of a repository semgrep scans for the correctness metric, and with what
+    # limits. Only files with one of 'extensions' are scanned. Files or directories matching an
+    # 'exclude' pattern (vendored dependencies, build output, bundles, fixtures and docs) are
+    # skipped, as are files over 'max_file_bytes', files that look minified, symbolic links (often
+    # dangling in a fresh clone) and files that cannot be read. semgrep itself is given a per-file
+    # timeout, a memory cap and a job count.
+
+    def __init__(self, extensions=SCAN_EXTENSIONS, exclude=SCAN_EXCLUDE, max_file_bytes=SCAN_MAX_FILE_BYTES,
+                 timeout=SEMGREP_TIMEOUT, max_memory=SEMGREP_MAX_MEMORY, jobs=SEMGREP_JOBS):
+        self.extensions     = tuple(extensions)
+        self.exclude        = list(exclude)
+        self.max_file_bytes = max_file_bytes
+        self.timeout        = timeout
+        self.max_memory     = max_memory
+        self.jobs           = jobs
+
+    def targets(self, path):
+        # Returns the files under 'path' to scan, and a count of the files skipped for each reason.
+        files   = []
+        skipped = {"excluded": 0, "language": 0, "size": 0, "minified": 0, "symlink": 0, "unreadable": 0}
+
+        for root, directories, names in os.walk(path):
+            kept = []
+            for directory in directories:
+                if self.__is_excluded(directory, os.path.relpath(os.path.join(root, directory), path)):
+                    skipped["excluded"] += 1
+                else:
+                    kept.append(directory)
+            directories[:] = sorted(kept)
+
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                if not name.endswith(self.extensions):
+                    skipped["language"] += 1
+                elif self.__is_excluded(name, os.path.relpath(file_path, path)):
+                    skipped["excluded"] += 1
+                elif os.path.islink(file_path):
+                    skipped["symlink"] += 1
+                else:
+                    try:
+                        if os.path.getsize(file_path) > self.max_file_bytes:
+                            skipped["size"] += 1
+                        elif self.__looks_minified(file_path):
+                            skipped["minified"] += 1
+                        else:
+                            files.append(file_path)
+                    except OSError:
+                        skipped["unreadable"] += 1
+
+        return files, skipped
+
+    def semgrep_options(self):
+        return ["--timeout", str(self.timeout), "--max-memory", str(self.max_memory), "--jobs", str(self.jobs)]
+
+    def fingerprint(self):
+        # A short hash of the settings that change which findings a scan can report.
+        settings = [",".join(self.extensions), ",".join(self.exclude), str(self.max_file_bytes), str(self.timeout)]
+        return hashlib.sha256("\n".join(settings).encode()).hexdigest()[:12]
+
+    def __is_excluded(self, name, relative_path):
+        for pattern in self.exclude:
+            if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern):
+                return True
+        return False
+
+    def __looks_minified(self, file_path):
+        with open(file_path, "rb") as file:
+            head = file.read(4 * MINIFIED_LINE_LENGTH)
+        return len(head) == 4 * MINIFIED_LINE_LENGTH and max(len(line) for line in head.split(b"\n")) >= MINIFIED_LINE_LENGTH
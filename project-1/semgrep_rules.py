@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+
+from datetime import datetime
+
+from clone_cache import EntryLock
+from http_cache import get_session
+from log import log
+
+RULES_DIR      = os.environ.get("SEMGREP_RULES_DIR", os.path.join(tempfile.gettempdir(), "ece461-semgrep-rules"))
+RULES_MAX_AGE  = int(os.environ.get("SEMGREP_RULES_MAX_AGE", 7 * 24 * 60 * 60)) # seconds before refresh fetches a pack again
+REGISTRY_URL   = os.environ.get("SEMGREP_REGISTRY_URL", "https://semgrep.dev/c/")
+REGISTRY_NAMES = ("p/", "r/", "s/")
+
+class RuleCache():
+    # Keeps local copies of semgrep registry rule packs (such as "p/r2c-bug-scan") so semgrep can
+    # be given rule files instead of downloading the pack on every scan. Scoring only reads the
+    # cache: packs are fetched, and rule-set versions recorded, by "python semgrep_rules.py
+    # refresh" (for example from a scheduled job), which fetches packs that are missing or older
+    # than 'max_age'. manifest.json records the sha256 of every pack and, for every rule-set
+    # version, the checksums it was made from. Each fetched version of a pack gets its own file,
+    # named by its checksum, so a running process keeps scanning with the copy it resolved at
+    # startup; older copies are left in place for such processes.
+
+    def __init__(self, directory=RULES_DIR, max_age=RULES_MAX_AGE, registry_url=REGISTRY_URL):
+        self.directory    = directory
+        self.max_age      = max_age
+        self.registry_url = registry_url
+        self.__lock       = EntryLock(os.path.join(directory, "manifest.lock"))
+
+    def is_registry_config(self, config):
+        return config.startswith(REGISTRY_NAMES)
+
+    def resolve(self, config):
+        # Returns the path of the local copy of a registry config. Configs that are not registry
+        # names are returned unchanged, as are registry names that have never been fetched, which
+        # semgrep then downloads itself. Never writes to the cache.
+        if not self.is_registry_config(config):
+            return config
+
+        entry = self.__manifest().get("packs", {}).get(config)
+        if entry is None or not os.path.exists(os.path.join(self.directory, entry["file"])):
+            return config
+        return os.path.join(self.directory, entry["file"])
+
+    def is_due(self, config):
+        # Whether refresh should fetch a registry config: never fetched or older than 'max_age'
+        entry = self.__manifest().get("packs", {}).get(config)
+        return entry is None or time.time() - entry["fetched_at"] > self.max_age
+
+    def refresh(self, config):
+        # Downloads a registry pack and records it in the manifest. Returns its manifest entry.
+        response = get_session().get(self.registry_url + config, timeout=60)
+        response.raise_for_status()
+        content = response.content
+
+        sha256    = hashlib.sha256(content).hexdigest()
+        file_name = config.replace("/", "_") + "-" + sha256[:12] + ".yaml"
+        entry     = {
+            "file"       : file_name,
+            "sha256"     : sha256,
+            "fetched_at" : time.time(),
+            "fetched"    : datetime.utcnow().isoformat() + "Z",
+            "source"     : self.registry_url + config,
+        }
+
+        with self.__lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self.__write(os.path.join(self.directory, file_name), content)
+            manifest = self.__manifest()
+            manifest.setdefault("packs", {})[config] = entry
+            self.__write(self.__manifest_path(), json.dumps(manifest, indent=4, sort_keys=True).encode())
+
+        log.log_rule_pack_refreshed(config, entry["sha256"])
+        return entry
+
+    def record_version(self, version, checksums):
+        # Records in the manifest which config checksums make up a rule-set version.
+        if self.__manifest().get("versions", {}).get(version) == checksums:
+            return
+
+        with self.__lock:
+            os.makedirs(self.directory, exist_ok=True)
+            manifest = self.__manifest()
+            manifest.setdefault("versions", {})[version] = checksums
+            self.__write(self.__manifest_path(), json.dumps(manifest, indent=4, sort_keys=True).encode())
+
+    def __manifest(self):
+        try:
+            with open(self.__manifest_path(), "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def __manifest_path(self):
+        return os.path.join(self.directory, "manifest.json")
+
+    def __write(self, path, content):
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        with open(temp, "wb") as file:
+            file.write(content)
+        os.replace(temp, path)
+
+def read_configs(semgrep_file):
+    # Returns the semgrep configs listed in a file, one per line.
+    configs = []
+    with open(semgrep_file, "r") as filePtr:
+        for line in filePtr.readlines():
+            if line.endswith("\n"):
+                line = line[:-1]
+            if line:
+                configs.append(line)
+    return configs
+
+if __name__ == "__main__":
+    # python semgrep_rules.py refresh [semgrep.txt] fetches every registry pack listed in the file
+    # that is due and records the resulting rule-set version, for example from a scheduled job.
+    # Running processes keep the rule-set version they started with until they are restarted.
+    from semgrep_scan import SemgrepScanner
+
+    semgrep_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "semgrep.txt")
+    if len(sys.argv) < 2 or sys.argv[1] != "refresh":
+        exit("usage: python semgrep_rules.py refresh [semgrep file]")
+
+    cache   = RuleCache()
+    configs = read_configs(semgrep_file)
+    for config in configs:
+        if cache.is_registry_config(config) and cache.is_due(config):
+            try:
+                print(config, cache.refresh(config)["sha256"])
+            except Exception as e:
+                log.log_rule_pack_refresh_failed(config, e)
+                print(config, "could not be fetched:", e)
+
+    scanner = SemgrepScanner(configs, rules=cache)
+    version = scanner.ruleset_version()
+    cache.record_version(version, scanner.checksums())
+    print("rule-set version", version)
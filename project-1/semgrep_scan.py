@@ -0,0 +1,175 @@
+import os
+import time
+import json
+import hashlib
+import tempfile
+import subprocess
+
+import yaml
+
+from deadline import Deadline, DeadlineExceeded
+from log import log
+
+SEMGREP_CACHE_DIR = os.environ.get("SEMGREP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ece461-semgrep-cache"))
+
+class SemgrepScanner():
+    # Runs a list of semgrep configs against a repository in a single semgrep process and splits
+    # the findings back into a count per config. Counts are cached on disk under the scanned
+    # commit's sha and a hash of the rule set, so an unchanged repository is never scanned twice.
+    # Findings are attributed to a local config (a rule file or directory) by rule id. Given a
+    # RuleCache, registry configs such as "p/r2c-bug-scan" are replaced by their local copies and
+    # are attributed the same way; registry configs without a local copy cannot be told apart by
+    # id, so they share the remaining findings. Given a ScanScope, only the files it selects are
+    # scanned, under its semgrep limits. Config paths and the rule-set hash are fixed when the
+    # scanner is built; the rule cache never rewrites a pack file in place, so they stay accurate.
+
+    # Target files passed to one semgrep process, to stay well under the argument length limit
+    TARGETS_PER_RUN = 1000
+
+    def __init__(self, configs, cache_dir=SEMGREP_CACHE_DIR, rules=None, scope=None):
+        self.configs    = configs
+        self.cache_dir  = cache_dir
+        self.rules      = rules
+        self.scope      = scope
+        self.__paths    = {config: self.__resolve(config) for config in configs}
+        self.__rule_ids = {config: self.__local_rule_ids(config) for config in configs}
+        self.__hash     = self.__hash_rules()
+
+    def ruleset_hash(self):
+        return self.__hash
+
+    def __hash_rules(self):
+        # Local configs are hashed by content. Registry configs can only be hashed by name.
+        digest = hashlib.sha256()
+        for config in self.configs:
+            digest.update(config.encode() + b"\0")
+            for path in self.__rule_files(config):
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+        return digest.hexdigest()
+
+    def ruleset_version(self):
+        # The short form of ruleset_hash() that is stored with each score. The rule cache's
+        # manifest records which pack checksums make up each version, see semgrep_rules.py.
+        return self.ruleset_hash()[:12]
+
+    def checksums(self):
+        # The sha256 of each config's rule files, None for a registry config without a local copy
+        return {config: self.__checksum(config) for config in self.configs}
+
+    def scan(self, path, commit_sha, deadline=None):
+        # Returns a dictionary with the number of findings of each config in the repository at 'path'.
+        # semgrep is stopped, raising DeadlineExceeded, if it is still running at the deadline.
+        key = commit_sha + "-" + self.ruleset_hash()
+        if self.scope is not None:
+            key += "-" + self.scope.fingerprint()
+
+        cache_path = os.path.join(self.cache_dir, key + ".json")
+        try:
+            with open(cache_path, "r") as file:
+                counts = json.load(file)
+            log.log_semgrep_cache_hit(os.path.basename(path), commit_sha)
+            return counts
+        except (OSError, ValueError):
+            pass
+
+        counts = self.count_by_config(self.__run(path, deadline or Deadline()))
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp = cache_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp, "w") as file:
+            json.dump(counts, file)
+        os.replace(temp, cache_path)
+        return counts
+
+    def count_by_config(self, results):
+        registry = [config for config in self.configs if self.__rule_ids[config] is None]
+        shared   = " + ".join(registry) if registry else "unattributed"
+        counts   = {config: 0 for config in self.configs if config not in registry}
+        if registry:
+            counts[shared] = 0
+
+        for result in results:
+            config = self.__owner(result["check_id"])
+            if config is None:
+                config = shared
+            counts[config] = counts.get(config, 0) + 1
+
+        return counts
+
+    def __owner(self, check_id):
+        # semgrep prefixes the ids of local rules with the dotted path of their file.
+        for config, rule_ids in self.__rule_ids.items():
+            if rule_ids is None:
+                continue
+            for rule_id in rule_ids:
+                if check_id == rule_id or check_id.endswith("." + rule_id):
+                    return config
+        return None
+
+    def __run(self, path, deadline):
+        command = ["semgrep", "--json", "-q"]
+        for config in self.configs:
+            command += ["--config", self.__paths[config]]
+
+        if self.scope is None:
+            return self.__semgrep(command + [path], deadline)
+
+        start            = time.monotonic()
+        targets, skipped = self.scope.targets(path)
+        command         += self.scope.semgrep_options()
+
+        results = []
+        for i in range(0, len(targets), self.TARGETS_PER_RUN):
+            results += self.__semgrep(command + targets[i:i + self.TARGETS_PER_RUN], deadline)
+
+        log.log_semgrep_scan(os.path.basename(path), len(targets), skipped, time.monotonic() - start)
+        return results
+
+    def __semgrep(self, command, deadline):
+        try:
+            output = subprocess.run(command, shell=False, stdout=subprocess.PIPE, timeout=deadline.timeout())
+        except subprocess.TimeoutExpired:
+            raise DeadlineExceeded("semgrep ran past its deadline")
+        return json.loads(output.stdout)["results"]
+
+    def __resolve(self, config):
+        # Relative local configs are looked up next to this module, like semgrep.txt.
+        if self.rules is not None and self.rules.is_registry_config(config):
+            return self.rules.resolve(config)
+        local = os.path.join(os.path.dirname(os.path.abspath(__file__)), config)
+        return local if not os.path.isabs(config) and os.path.exists(local) else config
+
+    def __checksum(self, config):
+        files = self.__rule_files(config)
+        if not files:
+            return None
+        digest = hashlib.sha256()
+        for path in files:
+            with open(path, "rb") as file:
+                digest.update(file.read())
+        return digest.hexdigest()
+
+    def __rule_files(self, config):
+        path = self.__paths[config]
+        if os.path.isfile(path):
+            return [path]
+        if os.path.isdir(path):
+            files = []
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names) if name.endswith((".yaml", ".yml"))]
+            return sorted(files)
+        return []
+
+    def __local_rule_ids(self, config):
+        # Returns the ids of the rules in a local config, or None for a registry config.
+        files = self.__rule_files(config)
+        if not files:
+            return None
+
+        rule_ids = set()
+        for path in files:
+            with open(path, "r") as file:
+                document = yaml.safe_load(file) or {}
+            rule_ids.update(rule["id"] for rule in document.get("rules", []))
+        return rule_ids
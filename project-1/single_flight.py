@@ -0,0 +1,56 @@
+import threading
+
+class Call():
+    # One in-flight call of SingleFlight.do and the callers waiting for it.
+
+    def __init__(self):
+        self.done    = threading.Event()
+        self.result  = None
+        self.error   = None
+        self.waiters = 0
+
+class SingleFlight():
+    # Runs at most one call per key at a time. A caller that arrives while a call for the same key is
+    # in flight waits for that call and gets its result, or its exception, instead of repeating the
+    # work. Nothing is remembered once a call finishes, so a later caller runs the work again.
+
+    def __init__(self):
+        self.__lock   = threading.Lock()
+        self.__calls  = {}
+        self.__counts = {'executions': 0, 'coalesced': 0, 'shared_errors': 0}
+
+    def do(self, key, work):
+        with self.__lock:
+            call   = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.__calls[key] = Call()
+                self.__counts['executions'] += 1
+            else:
+                call.waiters += 1
+                self.__counts['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                with self.__lock:
+                    self.__counts['shared_errors'] += 1
+                raise call.error
+            return call.result
+
+        try:
+            call.result = work()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats['in_flight'] = len(self.__calls)
+        return stats
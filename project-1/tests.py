@@ -2,14 +2,29 @@ import unittest
 import warnings
 import os
 import datetime
+import time
+import requests
 import subprocess
+import json
+import threading
+import http.server
+import tempfile
 
 from github import Github
 
-from repository import Repository
-from metrics import BusFactorMetric, CorrectnessMetric, RampUpMetric, ResponsivenessMetric, LicenseMetric
+from repository import Repository, pipelined
+from github_graphql import GitHubGraphQL
+from http_cache import HTTPCache, CachingAdapter
+from clone_cache import CloneCache
+from semgrep_scan import SemgrepScanner
+from semgrep_rules import RuleCache
+from scan_scope import ScanScope
+from deadline import Deadline, DeadlineExceeded
+from single_flight import SingleFlight
+from metric_costs import MetricCosts
+from metrics import Metric, BusFactorMetric, CorrectnessMetric, RampUpMetric, ResponsivenessMetric, LicenseMetric
 from score import Ranking 
-from main import create_list_of_repositories, find_rankings, print_results, clear_log_file
+from proj1 import create_list_of_repositories, find_rankings, print_results, clear_log_file, evaluate_metrics_early, ruleset_version
 
 def test_clear_log_file(repo):
     # We test to see if the function "clear_log_file()" actually clears the log file. This is necessary
@@ -316,6 +331,535 @@ def test_metric_when_empty(repo):
 
     return True
 
+class MockGraphQLHandler(http.server.BaseHTTPRequestHandler):
+    # Answers GraphQL queries with canned data for a repository with 2 pages of open issues, 1 open
+    # pull request and 3 commits (2 by the same author, 1 without a GitHub user) in the past year.
+    # The text of every query received is kept in 'queries'.
+
+    queries = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        MockGraphQLHandler.queries.append(body["query"])
+
+        issue_page_2 = {
+            "totalCount": 2,
+            "pageInfo"  : {"hasNextPage": False, "endCursor": "c2"},
+            "nodes"     : [{"title": "issue 2", "createdAt": "2021-09-29T16:03:05Z"}],
+        }
+        if "after: $cursor" in body["query"]:
+            repository = {"issues": issue_page_2}
+        else:
+            repository = {
+                "name"           : "mock-repo",
+                "nameWithOwner"  : "mock-owner/mock-repo",
+                "stargazerCount" : 5,
+                "forkCount"      : 2,
+                "licenseInfo"    : {"spdxId": "MIT"},
+                "packageJson"    : {"text": '{"dependencies": {"a": "1", "b": "2"}}'},
+                "readme0"        : None,
+                "readme1"        : {"text": "line 1\nline 2\n"},
+                "issues"         : {
+                    "totalCount": 2,
+                    "pageInfo"  : {"hasNextPage": True, "endCursor": "c1"},
+                    "nodes"     : [{"title": "issue 1", "createdAt": "2021-10-03T18:57:00Z"}],
+                },
+                "pullRequests"   : {
+                    "totalCount": 1,
+                    "pageInfo"  : {"hasNextPage": False, "endCursor": None},
+                    "nodes"     : [{"title": "pull request 1", "createdAt": "2021-09-29T16:02:47Z"}],
+                },
+                "defaultBranchRef" : {"target": {"history": {
+                    "pageInfo": {"hasNextPage": False, "endCursor": None},
+                    "nodes"   : [
+                        {"author": {"user": {"id": "U_1"}}},
+                        {"author": {"user": {"id": "U_1"}}},
+                        {"author": {"user": None}},
+                    ],
+                }}},
+            }
+        for i in range(2, 7):
+            repository.setdefault("readme" + str(i), None)
+
+        payload = json.dumps({"data": {"repository": repository}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        return
+
+def start_mock_server(handler):
+    server = http.server.HTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def test_graphql_repository(repo):
+    # A Repository built from the GraphQL API should hold the same data as one built from the REST API.
+    # The mock endpoint serves everything in one query plus one follow-up query for the second page of
+    # open issues, so exactly 2 requests should be made.
+
+    server  = start_mock_server(MockGraphQLHandler)
+    graphql = GitHubGraphQL("token", url="http://127.0.0.1:" + str(server.server_port))
+    try:
+        mock_repo = Repository('https://github.com/mock-owner/mock-repo', None, graphql, fields=Repository.FIELDS)
+    finally:
+        server.shutdown()
+
+    expected = {
+        "name"              : "mock-repo",
+        "num_stars"         : 5,
+        "num_forks"         : 2,
+        "num_pull_requests" : 1,
+        "open_issues"       : 3,
+        "commits"           : 2,
+        "read_me"           : "line 1\nline 2\n",
+        "num_dependencies"  : 2,
+        "license_name"      : "MIT",
+        "requests"          : 2,
+    }
+    fetched = {
+        "name"              : mock_repo.name,
+        "num_stars"         : mock_repo.num_stars,
+        "num_forks"         : mock_repo.num_forks,
+        "num_pull_requests" : mock_repo.num_pull_requests,
+        "open_issues"       : len(mock_repo.open_issues),
+        "commits"           : len(mock_repo.commits),
+        "read_me"           : mock_repo.read_me,
+        "num_dependencies"  : mock_repo.num_dependencies,
+        "license_name"      : mock_repo.license_name,
+        "requests"          : graphql.num_requests,
+    }
+
+    for key in expected:
+        if fetched[key] != expected[key]:
+            print(f"The GraphQL fetch should give '{key}' as {expected[key]}, but it was {fetched[key]}.")
+            return False
+
+    return True
+
+def test_lazy_repository(repo):
+    # A Repository should fetch only the fields it is asked for up front, in one query that leaves out
+    # everything else, and fetch any other field once, on first access.
+
+    server  = start_mock_server(MockGraphQLHandler)
+    graphql = GitHubGraphQL("token", url="http://127.0.0.1:" + str(server.server_port))
+    MockGraphQLHandler.queries = []
+    try:
+        mock_repo = Repository('https://github.com/mock-owner/mock-repo', None, graphql, fields=("license_name",))
+        query     = MockGraphQLHandler.queries[0]
+        prefetch  = graphql.num_requests
+        stars     = mock_repo.num_stars
+        stars     = mock_repo.num_stars
+        license   = mock_repo.license_name
+    finally:
+        server.shutdown()
+
+    if prefetch != 1 or "licenseInfo" not in query:
+        print(f"The license should have been fetched in 1 query up front, but {prefetch} were made.")
+        return False
+    for part in ["stargazerCount", "issues", "history", "readme0", "packageJson", "$since"]:
+        if part in query:
+            print(f"The query for the license should not ask for '{part}'.")
+            return False
+    if graphql.num_requests != 2 or stars != 5 or license != "MIT":
+        print(f"The stars should have been fetched once on first access, but {graphql.num_requests - 1} requests were made.")
+        return False
+
+    return True
+
+class MockETagHandler(http.server.BaseHTTPRequestHandler):
+    # Serves one JSON document with an ETag and answers 304 when the client already has it.
+
+    etag = '"v1"'
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            return
+
+        payload = b'{"name": "mock-repo"}'
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        return
+
+def test_http_cache(repo):
+    # The first request for a url should be a miss that stores the response. Repeating it should send
+    # the stored ETag, get a 304 back, and replay the stored body as a 200.
+
+    server = start_mock_server(MockETagHandler)
+    url    = "http://127.0.0.1:" + str(server.server_port) + "/repos/mock-owner/mock-repo"
+    with tempfile.TemporaryDirectory() as directory:
+        cache   = HTTPCache(directory)
+        session = requests.Session()
+        session.mount("http://", CachingAdapter(cache))
+        try:
+            first  = session.get(url)
+            second = session.get(url)
+        finally:
+            server.shutdown()
+        stats = cache.stats()
+
+    if second.status_code != 200 or second.json() != first.json():
+        print(f"The cached response should replay as 200 with body {first.json()}, but it was {second.status_code} with body {second.text}.")
+        return False
+
+    if stats["hits"] != 1 or stats["misses"] != 1 or stats["stores"] != 1:
+        print(f"The cache should count 1 hit, 1 miss and 1 store, but it counted {stats}.")
+        return False
+
+    return True
+
+class LocalRepository():
+    # Stands in for a Repository whose url points at a local git repository.
+
+    def __init__(self, full_name, url):
+        self.full_name = full_name
+        self.name      = full_name.split("/")[-1]
+        self.url       = url
+
+def commit_file(path, name, text):
+    with open(os.path.join(path, name), "w") as file:
+        file.write(text)
+    subprocess.run(["git", "add", name], cwd=path, check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@test", "commit", "-qm", name], cwd=path, check=True)
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=path, check=True, stdout=subprocess.PIPE).stdout.decode().strip()
+
+def test_clone_cache(repo):
+    # The first checkout of a repository should clone it to <owner>/<repo>. After a new commit is pushed
+    # to the origin, checking out again should update the same entry to the new HEAD.
+
+    with tempfile.TemporaryDirectory() as directory:
+        origin = os.path.join(directory, "origin")
+        os.makedirs(origin)
+        subprocess.run(["git", "init", "-q", origin], check=True)
+        first_sha = commit_file(origin, "index.js", "var a = 1;\n")
+
+        cache      = CloneCache(os.path.join(directory, "cache"))
+        local_repo = LocalRepository("mock-owner/mock-repo", "file://" + origin)
+        path       = cache.checkout(local_repo)
+
+        expected_path = os.path.join(directory, "cache", "mock-owner", "mock-repo")
+        if path != expected_path or cache.head(path) != first_sha:
+            print(f"The first checkout should be at {expected_path} on {first_sha}, but it was at {path} on {cache.head(path)}.")
+            return False
+
+        second_sha = commit_file(origin, "index.js", "var a = 2;\n")
+        cache.checkout(local_repo)
+
+        if cache.head(path) != second_sha:
+            print(f"The updated checkout should be on {second_sha}, but it was on {cache.head(path)}.")
+            return False
+
+    return True
+
+def test_semgrep_split(repo):
+    # Findings from one semgrep run over several configs should be counted per config: findings of rules
+    # in a local rule file go to that file, everything else goes to the registry config. Counts for a
+    # commit that was already scanned should come from the cache without running semgrep.
+
+    with tempfile.TemporaryDirectory() as directory:
+        rule_file = os.path.join(directory, "rules.yaml")
+        with open(rule_file, "w") as file:
+            file.write("rules:\n  - id: no-eval\n  - id: no-with\n")
+
+        scanner = SemgrepScanner(["p/r2c-bug-scan", rule_file], os.path.join(directory, "cache"))
+        results = [
+            {"check_id": "tmp.rules.no-eval"},
+            {"check_id": "tmp.rules.no-with"},
+            {"check_id": "javascript.lang.correctness.useless-eqeq"},
+        ]
+        counts = scanner.count_by_config(results)
+
+        expected_counts = {"p/r2c-bug-scan": 1, rule_file: 2}
+        if counts != expected_counts:
+            print(f"The semgrep findings should be split as {expected_counts}, but they were split as {counts}.")
+            return False
+
+        os.makedirs(scanner.cache_dir)
+        with open(os.path.join(scanner.cache_dir, "abc123-" + scanner.ruleset_hash() + ".json"), "w") as file:
+            json.dump(expected_counts, file)
+        cached_counts = scanner.scan(directory, "abc123")
+
+        if cached_counts != expected_counts:
+            print(f"The cached semgrep counts should be {expected_counts}, but they were {cached_counts}.")
+            return False
+
+    return True
+
+class MockRegistryHandler(http.server.BaseHTTPRequestHandler):
+    # Serves a one-rule pack for any registry config.
+
+    def do_GET(self):
+        payload = b"rules:\n  - id: javascript.no-eval\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-yaml")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        return
+
+def test_rule_cache(repo):
+    # Scanning should never fetch a registry config. Once refreshed into the rule cache it should be passed
+    # to semgrep as a local file, so its findings can be attributed by rule id. The manifest should record
+    # the pack's checksum under the rule-set version. Every CorrectnessMetric should scan with the one
+    # scanner whose version scores are stored under.
+
+    server = start_mock_server(MockRegistryHandler)
+    with tempfile.TemporaryDirectory() as directory:
+        rules = RuleCache(os.path.join(directory, "rules"), registry_url="http://127.0.0.1:" + str(server.server_port) + "/c/")
+        try:
+            unrefreshed = rules.resolve("p/r2c-bug-scan")
+            written     = os.path.exists(os.path.join(directory, "rules"))
+            rules.refresh("p/r2c-bug-scan")
+            scanner     = SemgrepScanner(["p/r2c-bug-scan"], os.path.join(directory, "cache"), rules)
+        finally:
+            server.shutdown()
+
+        counts  = scanner.count_by_config([{"check_id": "rules.p_r2c-bug-scan.javascript.no-eval"}])
+        version = scanner.ruleset_version()
+        rules.record_version(version, scanner.checksums())
+        with open(os.path.join(directory, "rules", "manifest.json")) as file:
+            manifest = json.load(file)
+
+    if unrefreshed != "p/r2c-bug-scan" or written:
+        print(f"A pack that was never refreshed should be left to semgrep, but it resolved to {unrefreshed}.")
+        return False
+    if counts != {"p/r2c-bug-scan": 1}:
+        print(f"The rule pack's finding should be attributed to it, but the counts were {counts}.")
+        return False
+
+    checksum = manifest["packs"]["p/r2c-bug-scan"]["sha256"]
+    if manifest["versions"].get(version) != {"p/r2c-bug-scan": checksum}:
+        print(f"The manifest should record rule-set version {version} as the pack's checksum {checksum}, but it has {manifest['versions']}.")
+        return False
+    if not manifest["packs"]["p/r2c-bug-scan"]["file"].endswith(checksum[:12] + ".yaml"):
+        print("Each fetched version of a pack should get its own file, so a running scanner's copy is never rewritten.")
+        return False
+
+    scanner = CorrectnessMetric("CORRECTNESS_SCORE", .2).scanner()
+    if scanner is not CorrectnessMetric("CORRECTNESS_SCORE", .2).scanner() or scanner.ruleset_version() != ruleset_version():
+        print("Every CorrectnessMetric should scan with the scanner the rule-set version was taken from.")
+        return False
+
+    return True
+
+def test_scan_scope(repo):
+    # Only the repository's own JavaScript sources should be scanned. Dependencies, build output,
+    # minified files, other languages, files over the size cap and symbolic links, even dangling ones,
+    # should be skipped.
+
+    files = {
+        "src/index.js"               : "var a = 1;\n",
+        "src/util.ts"                : "let b: number = 2;\n",
+        "node_modules/dep/index.js"  : "var c = 3;\n",
+        "dist/bundle.js"             : "var d = 4;\n",
+        "lib/app.min.js"             : "var e = 5;\n",
+        "lib/generated.js"           : "var f = 6;" * 1000,
+        "lib/large.js"               : "var g = 7;\n" * 1000,
+        "README.md"                  : "# readme\n",
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, text in files.items():
+            os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+            with open(os.path.join(directory, name), "w") as file:
+                file.write(text)
+        os.symlink(os.path.join(directory, "missing.js"), os.path.join(directory, "src", "dangling.js"))
+
+        scope            = ScanScope(max_file_bytes=10000)
+        targets, skipped = scope.targets(directory)
+        targets          = sorted(os.path.relpath(target, directory) for target in targets)
+
+    expected_targets = ["src/index.js", "src/util.ts"]
+    expected_skipped = {"excluded": 3, "language": 1, "size": 1, "minified": 1, "symlink": 1, "unreadable": 0}
+
+    if targets != expected_targets or skipped != expected_skipped:
+        print(f"The scan should target {expected_targets} and skip {expected_skipped}, but it targeted {targets} and skipped {skipped}.")
+        return False
+
+    return True
+
+def test_single_flight(repo):
+    # Callers asking for the same key while its work is running should wait for that run and share
+    # its result, and the work should run only once. A different key should run on its own.
+
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    runs    = []
+    results = []
+
+    def work():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return {"score": 1}
+
+    def call(key):
+        results.append(flights.do(key, work))
+
+    threads = [threading.Thread(target=call, args=("owner/repo",))]
+    threads[0].start()
+    started.wait(5)
+    for _ in range(4):
+        threads.append(threading.Thread(target=call, args=("owner/repo",)))
+        threads[-1].start()
+    waited = time.monotonic() + 5
+    while flights.stats()["coalesced"] < 4 and time.monotonic() < waited:
+        threading.Event().wait(0.01)
+    coalesced = flights.stats()["coalesced"]
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    if coalesced < 4:
+        print(f"Four callers should have joined the running call within 5 seconds, but {coalesced} did.")
+        return False
+    flights.do("owner/other", work)
+
+    stats = flights.stats()
+    if len(runs) != 2 or results != [{"score": 1}] * 5 or stats["coalesced"] != 4 or stats["in_flight"] != 0:
+        print(f"Five concurrent calls should share one run, but the work ran {len(runs) - 1} times, returned {results} and counted {stats}.")
+        return False
+
+    return True
+
+class TimedMetric(Metric):
+    # A metric with a fixed raw score that records the order in which metrics ran.
+
+    def __init__(self, name, weight, ran):
+        super().__init__(name, weight)
+        self.ran = ran
+
+    def calculate_score(self, repo, deadline=None):
+        self.ran.append(self.name)
+        return 1
+
+def test_early_exit(repo):
+    # Metrics should run cheapest first and stop once the total is certain to pass the threshold, with the
+    # skipped metrics left as None. The measured costs should be kept in memory until saved, then reloaded.
+
+    with tempfile.TemporaryDirectory() as directory:
+        costs_file = os.path.join(directory, "metric_costs.json")
+        costs      = MetricCosts(costs_file)
+        costs.record("EXPENSIVE", 30.0)
+        costs.record("CHEAP", 0.01)
+        costs.record("MEDIUM", 1.0)
+
+        ran     = []
+        metrics = [TimedMetric("EXPENSIVE", .5, ran), TimedMetric("CHEAP", .2, ran), TimedMetric("MEDIUM", .2, ran)]
+        weighted, lower, upper = evaluate_metrics_early(repo, metrics, .25, costs)
+        written  = os.path.exists(costs_file)
+        costs.save()
+        reloaded = MetricCosts(costs_file)
+
+    if ran != ["CHEAP", "MEDIUM"] or weighted[0] is not None or abs(lower - .4) > 1e-9 or abs(upper - .9) > 1e-9:
+        print(f"Scoring should run CHEAP and MEDIUM and stop with bounds 0.4 and 0.9, but it ran {ran} with bounds {lower} and {upper}.")
+        return False
+    if written:
+        print("Recorded metric costs should not be written to disk on every measurement.")
+        return False
+    if abs(reloaded.estimate("EXPENSIVE") - 30.0) > 1e-9 or reloaded.estimate("CHEAP") > 1.0:
+        print(f"Recorded metric costs should be reloaded from disk, but they are {reloaded.stats()}.")
+        return False
+
+    return True
+
+class SlowMetric(Metric):
+    # A metric that takes longer than its budget unless it notices the deadline.
+
+    budget = 0.2
+
+    def calculate_score(self, repo, deadline=None):
+        while not deadline.expired():
+            threading.Event().wait(0.01)
+        return 1
+
+def test_deadline(repo):
+    # A metric that overruns its budget should be abandoned with no score, well before it would have
+    # finished. A budget should never outlast the run's deadline.
+
+    run     = Deadline(60)
+    started = datetime.datetime.now()
+    score   = SlowMetric("SLOW", .5).calculate_score_within(repo, run)
+    elapsed = (datetime.datetime.now() - started).total_seconds()
+
+    if score is not None or elapsed > 2:
+        print(f"An overrunning metric should give no score within its 0.2s budget, but it gave {score} after {elapsed}s.")
+        return False
+    if run.within(120).expires != run.expires or Deadline().timeout(30) != 30 or Deadline(10).timeout(5) != 5:
+        print("Budgets and timeouts should be capped by the deadline.")
+        return False
+
+    return True
+
+def test_fetch_deadline(repo):
+    # A repository whose fetch runs past the deadline should still be created, with the fields left
+    # unfetched, and a metric reading one of them should be imputed instead of failing the run.
+
+    server  = start_mock_server(MockGraphQLHandler)
+    graphql = GitHubGraphQL("token", url="http://127.0.0.1:" + str(server.server_port))
+    try:
+        late_repo = Repository('https://github.com/mock-owner/mock-repo', None, graphql, Deadline(0), Repository.FIELDS)
+        score     = RampUpMetric("RAMP_UP_SCORE", .2).calculate_score_within(late_repo, Deadline(5))
+    except DeadlineExceeded as e:
+        print(f"Running past the deadline while fetching should not fail the repository: {e}")
+        return False
+    finally:
+        server.shutdown()
+
+    if "read_me" in late_repo.__dict__ or score is not None:
+        print(f"The README should be left unfetched and ramp up imputed, but the score was {score}.")
+        return False
+
+    return True
+
+class RecordingPages():
+    # A PaginatedList stand-in that records, for each page requested, how many items had been processed
+    # by then. 'processed' is appended to by the caller as it finishes each item.
+
+    def __init__(self, pages):
+        self.pages     = pages
+        self.processed = []
+        self.requested = {}
+        self.events    = [threading.Event() for _ in range(len(pages) + 1)]
+
+    def get_page(self, page):
+        self.requested[page] = len(self.processed)
+        self.events[page].set()
+        return self.pages[page] if page < len(self.pages) else []
+
+def test_pipelined_pages(repo):
+    # Page N+1 should be requested while the items of page N are processed, before the last of them is
+    # finished, instead of once they run out. A short page is the last. The last item of each full page
+    # waits up to 5 seconds for the next page to be requested, so the test does not depend on timing.
+
+    pages = RecordingPages([[1, 2], [3, 4], [5]])
+    for item in pipelined(pages, 2, Deadline(), "Fetching pages"):
+        if item % 2 == 0:
+            pages.events[item // 2].wait(5)
+        pages.processed.append(item)
+
+    if pages.processed != [1, 2, 3, 4, 5] or sorted(pages.requested) != [0, 1, 2]:
+        print(f"All 5 items of pages 0 to 2 should have been read, but items {pages.processed} of pages {sorted(pages.requested)} were.")
+        return False
+    if pages.requested[1] >= 2 or pages.requested[2] >= 4:
+        print(f"Each page should be requested before the last item of the page before it is processed, but they were requested after {pages.requested} items.")
+        return False
+
+    return True
+
 def test():
     # Here we run our tests. Most tests are a function that accept a 'repo' argument. These test functions are
     # stored in a list and iterated through. Other tests accept unique arguments, so they are run individually.
@@ -354,7 +898,19 @@ def test():
         test_score_calculation,
         test_output,
         test_metric_when_empty,
-        test_clear_log_file
+        test_clear_log_file,
+        test_graphql_repository,
+        test_lazy_repository,
+        test_http_cache,
+        test_clone_cache,
+        test_semgrep_split,
+        test_rule_cache,
+        test_scan_scope,
+        test_single_flight,
+        test_early_exit,
+        test_deadline,
+        test_fetch_deadline,
+        test_pipelined_pages
     ]
     for test in repo_tests:
         if test(repo):
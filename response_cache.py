@@ -0,0 +1,91 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 2048))   # cached responses before the least recently used is evicted
+RESPONSE_CACHE_TTL  = float(os.environ.get('RESPONSE_CACHE_TTL', 60))   # seconds, bounds staleness from writes made by other instances
+
+class ResponseCache():
+    # An in-process LRU cache of serialized package responses with a time to live. Each entry carries
+    # tags such as "id:<package id>" and "name:<package name>" for the rows it was built from, and a write
+    # drops every entry sharing a tag with the rows it changed. A read that was already in flight when an
+    # invalidation happened may have loaded the old row, so put() refuses values loaded before the most
+    # recent invalidation. Writes made by other instances are only picked up once the TTL expires.
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.size         = size
+        self.ttl          = ttl
+        self.__lock       = threading.Lock()
+        self.__entries    = OrderedDict()   # key -> (expires, value, tags), least recently used first
+        self.__tags       = {}              # tag -> keys of the entries carrying it
+        self.__generation = 0
+        self.__counts     = {'hits': 0, 'misses': 0, 'stores': 0, 'stale_stores': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def generation(self):
+        # Taken before loading a value and handed back to put()
+        with self.__lock:
+            return self.__generation
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.__remove(key)
+                self.__counts['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.__counts['misses'] += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__counts['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value, tags, generation):
+        with self.__lock:
+            if generation != self.__generation:
+                self.__counts['stale_stores'] += 1
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.monotonic() + self.ttl, value, tags)
+            for tag in tags:
+                self.__tags.setdefault(tag, set()).add(key)
+            self.__counts['stores'] += 1
+
+            while len(self.__entries) > self.size:
+                self.__remove(next(iter(self.__entries)))
+                self.__counts['evictions'] += 1
+
+    def invalidate(self, tags):
+        with self.__lock:
+            self.__generation += 1
+            self.__counts['invalidations'] += 1
+            for tag in tags:
+                for key in list(self.__tags.get(tag, ())):
+                    self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__counts['invalidations'] += 1
+            self.__entries.clear()
+            self.__tags.clear()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats['entries'] = len(self.__entries)
+            stats['size']    = self.size
+            stats['ttl']     = self.ttl
+        return stats
+
+    def __remove(self, key):
+        # Caller holds the lock
+        expires, value, tags = self.__entries.pop(key)
+        for tag in tags:
+            keys = self.__tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__tags[tag]
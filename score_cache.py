@@ -0,0 +1,87 @@
+import os
+import json
+import threading
+
+SCORED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'                                   # UTC, the 'scored_at' of a score dictionary
+SCORE_CACHE_TTL  = int(os.environ.get('SCORE_CACHE_TTL', 24 * 60 * 60)) # seconds, bounds the age of responsiveness and bus factor
+
+class ScoreCache():
+    # Stores the sub-score dictionary of every scored repository in the score_cache table, keyed by
+    # (repository "owner/name", default branch HEAD sha, metric-set version). A package pointing at
+    # an unchanged repository can then reuse its scores instead of cloning and scanning it again.
+    # Responsiveness and bus factor depend on the current date, so entries older than 'ttl'
+    # seconds are ignored even if the commit has not changed. Scores stored without a 'scored_at'
+    # time are given the time they were stored.
+
+    def __init__(self, pool, ttl=SCORE_CACHE_TTL):
+        self.pool     = pool
+        self.ttl      = ttl
+        self.__lock   = threading.Lock()
+        self.__counts = {'hits': 0, 'misses': 0, 'stores': 0, 'invalidations': 0}
+
+    def create_table(self):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS score_cache (
+                repo VARCHAR(255) NOT NULL,
+                head_sha CHAR(40) NOT NULL,
+                metrics_version VARCHAR(32) NOT NULL,
+                scores TEXT NOT NULL,
+                created_at DATETIME NOT NULL,
+                PRIMARY KEY (repo, head_sha, metrics_version)
+            )""")
+            cnx.commit()
+            cursor.close()
+
+    def get(self, repo, head_sha, metrics_version):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("""
+            SELECT scores, created_at FROM score_cache
+            WHERE repo = %s AND head_sha = %s AND metrics_version = %s AND created_at > UTC_TIMESTAMP() - INTERVAL %s SECOND""",
+                    (repo, head_sha, metrics_version, self.ttl))
+            row = cursor.fetchone()
+            cursor.close()
+
+        self.__count('hits' if row else 'misses')
+        if row is None:
+            return None
+        scores = json.loads(row[0])
+        scores.setdefault('scored_at', row[1].strftime(SCORED_AT_FORMAT))
+        return scores
+
+    def put(self, repo, head_sha, metrics_version, scores):
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            cursor.execute("""
+            REPLACE INTO score_cache (repo, head_sha, metrics_version, scores, created_at) VALUES (%s,%s,%s,%s,UTC_TIMESTAMP())""",
+                    (repo, head_sha, metrics_version, json.dumps(scores)))
+            cnx.commit()
+            cursor.close()
+        self.__count('stores')
+
+    def invalidate(self, repo=None):
+        # Deletes the stored scores of one repository, or of every repository if none is given.
+        with self.pool.connection() as cnx:
+            cursor = cnx.cursor(buffered = True)
+            if repo is None:
+                cursor.execute("DELETE FROM score_cache")
+            else:
+                cursor.execute("DELETE FROM score_cache WHERE repo = %s",(repo,))
+            deleted = cursor.rowcount
+            cnx.commit()
+            cursor.close()
+
+        self.__count('invalidations')
+        return deleted
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats['ttl'] = self.ttl
+        return stats
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counts[name] += 1
@@ -0,0 +1,67 @@
+import json
+import datetime
+import decimal
+
+# package table column -> field of the API's PackageMetadata, PackageData and PackageRating objects
+METADATA_FIELDS = [('package_name', 'Name'), ('version', 'Version'), ('package_id', 'ID')]
+DATA_FIELDS     = [('content', 'Content'), ('url', 'URL'), ('jsprogram', 'JSProgram')]
+RATING_FIELDS   = [
+    ('ramp_up',        'RampUp'),
+    ('correctness',    'Correctness'),
+    ('bus_factor',     'BusFactor'),
+    ('responsiveness', 'ResponsiveMaintainer'),
+    ('license',        'LicenseScore'),
+    ('dependancy',     'GoodPinningPractice'),
+    ('overall',        'NetScore'),
+    ('scored_at',      'ScoredAt'),
+]
+
+def to_json_value(value):
+    # Converts the column types mysql.connector returns into JSON-compatible values.
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8', errors = 'replace')
+    return value
+
+def row_dict(column_names, row):
+    return dict(zip(column_names, row))
+
+def pick(row, fields):
+    # Maps the given columns of a row dictionary to API field names. Columns the table lacks are left out.
+    return {field: to_json_value(row[column]) for column, field in fields if column in row}
+
+def to_metadata(row):
+    return pick(row, METADATA_FIELDS)
+
+def to_package(row):
+    return {'metadata': to_metadata(row), 'data': pick(row, DATA_FIELDS)}
+
+def to_rating(row):
+    # 'Imputed' lists the sub-scores that are a stand-in because their metric did not finish in time
+    rating = pick(row, RATING_FIELDS)
+    if 'imputed' in row:
+        rating['Imputed'] = row['imputed'].split(',') if row['imputed'] else []
+    return rating
+
+def to_export_record(row):
+    # One line of GET /packages/export: the package with its rating and the time the row last changed
+    record = to_package(row)
+    record['rating'] = to_rating(row)
+    if 'updated_at' in row:
+        record['UpdatedAt'] = to_json_value(row['updated_at'])
+    return record
+
+def to_history_entry(row):
+    # The package table keeps no upload history, so an entry only carries the version's metadata
+    return {'PackageMetadata': to_metadata(row)}
+
+def dumps(value):
+    return json.dumps(value, default = to_json_value)
+
+def rows_to(column_names, rows, shape):
+    # Serializes cursor rows straight into a JSON array of API objects, 'shape' being one of
+    # to_metadata, to_package or to_rating.
+    return dumps([shape(row_dict(column_names, row)) for row in rows])
@@ -1,11 +1,10 @@
-import sqlite3
-from google.cloud import storage 
-import pandas as pd
-import numpy as np
-from datetime import datetime
 import mysql.connector
 import sys
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
 
 #### Establish Connection ###
 import yaml
@@ -18,6 +17,11 @@ with open('gcloud.yaml') as stream:
 if db_password is None:
     exit("No password set for Cloud SQL. Exiting...")
 
+#### Pool Settings ####
+DB_POOL_SIZE      = int(os.environ.get('DB_POOL_SIZE', 5))         # max open connections
+DB_POOL_TIMEOUT   = float(os.environ.get('DB_POOL_TIMEOUT', 10))   # seconds to wait for a free connection
+DB_POOL_PING_IDLE = float(os.environ.get('DB_POOL_PING_IDLE', 30)) # ping connections idle longer than this
+
 def connect():
 
     if os.environ.get('GAE_ENV') == 'standard':
@@ -27,11 +31,13 @@ def connect():
                 unix_socket='/cloudsql/{}'.format(db_connection),
                 user=db_username,
                 password=db_password,
-                database=db_database)
+                database=db_database,
+                time_zone='+00:00')
         except Exception as e:
             print("Error: ", e)
+            raise
     else:
-        cnx = mysql.connector.connect(user=db_username, password=db_password, host='35.229.85.24', database=db_database)
+        cnx = mysql.connector.connect(user=db_username, password=db_password, host='35.229.85.24', database=db_database, time_zone='+00:00')
 
     #### Connection Established ####
     print("Connection Established")
@@ -42,5 +48,197 @@ def connect():
 
     return cnx
 
+#### Schema Migrations ####
+# Columns added to the package table after it was first created. migrate() runs at startup and
+# applies the ALTER for every column the live table does not have yet.
+PACKAGE_MIGRATIONS = [
+    ('updated_at', "ADD COLUMN updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, "
+                   "ADD INDEX package_updated_at (updated_at)"),
+    ('row_version', "ADD COLUMN row_version INT UNSIGNED NOT NULL DEFAULT 1"),   # bumped by every UPDATE of the row
+    ('scored_at',   "ADD COLUMN scored_at DATETIME NULL"),                       # UTC time the stored scores were computed
+    ('imputed',     "ADD COLUMN imputed VARCHAR(255) NULL"),                     # sub-scores imputed because their metric ran out of time
+]
+
+def migrate(pool):
+    with pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'package'""")
+        existing = {row[0] for row in cursor.fetchall()}
+        for column, alter in PACKAGE_MIGRATIONS:
+            if column in existing:
+                continue
+            try:
+                cursor.execute("ALTER TABLE package " + alter)
+            except mysql.connector.Error as e:
+                # Another instance starting at the same time already added it
+                if e.errno != 1060:
+                    raise
+        # registry_meta's 'generation' counts committed writes to the package table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS registry_meta (
+            name VARCHAR(64) NOT NULL PRIMARY KEY,
+            value BIGINT UNSIGNED NOT NULL
+        )""")
+        cursor.execute("INSERT IGNORE INTO registry_meta (name, value) VALUES ('generation', 0)")
+        cnx.commit()
+        cursor.close()
+
+class PoolTimeout(Exception):
+    # Raised when no connection becomes free within the pool's timeout.
+    pass
+
+class ConnectionPool():
+    # A bounded, thread-safe pool of MySQL connections. Request handlers check a connection out
+    # with "with pool.connection() as cnx:" and it is returned when the block exits. Connections
+    # are opened lazily up to 'size'; after that callers wait up to 'timeout' seconds for one to
+    # be returned. A connection that sat idle for more than 'ping_idle' seconds is pinged (and
+    # reconnected if the server dropped it) before it is handed out. Any transaction left open by
+    # the caller is rolled back on return so the next user starts clean.
+
+    def __init__(self, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, ping_idle=DB_POOL_PING_IDLE, factory=connect):
+        self.size      = size
+        self.timeout   = timeout
+        self.ping_idle = ping_idle
+        self.__factory = factory
+        self.__idle    = queue.LifoQueue()
+        self.__lock    = threading.Lock()
+        self.__opened  = 0
+        self.__in_use  = 0
+
+        self.__stats = {
+            'checkouts'   : 0,
+            'waits'       : 0,
+            'wait_time'   : 0.0,
+            'max_wait'    : 0.0,
+            'timeouts'    : 0,
+            'pings'       : 0,
+            'reconnects'  : 0,
+            'discarded'   : 0,
+            'peak_in_use' : 0,
+        }
+
+    def acquire(self):
+        start = time.monotonic()
+        cnx, last_used = self.__checkout()
+        waited = time.monotonic() - start
+
+        if last_used is not None and time.monotonic() - last_used > self.ping_idle:
+            cnx = self.__ping(cnx)
+
+        with self.__lock:
+            self.__in_use += 1
+            self.__stats['checkouts'] += 1
+            self.__stats['wait_time'] += waited
+            self.__stats['max_wait']   = max(self.__stats['max_wait'], waited)
+            self.__stats['peak_in_use'] = max(self.__stats['peak_in_use'], self.__in_use)
+
+        return cnx
+
+    def release(self, cnx):
+        with self.__lock:
+            self.__in_use -= 1
+
+        try:
+            cnx.rollback()
+        except Exception:
+            self.__discard(cnx)
+            return
+
+        self.__idle.put((cnx, time.monotonic()))
+
+    def discard(self, cnx):
+        # Gives up a checked-out connection instead of releasing it, for a caller that stopped reading a
+        # result midway: rolling back would first read the rest of it. The socket is shut down unread.
+        with self.__lock:
+            self.__in_use -= 1
+
+        try:
+            cnx.shutdown()
+        except Exception:
+            pass
+        self.__discard(cnx)
+
+    @contextmanager
+    def connection(self):
+        cnx = self.acquire()
+        try:
+            yield cnx
+        finally:
+            self.release(cnx)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats['size']   = self.size
+            stats['opened'] = self.__opened
+            stats['in_use'] = self.__in_use
+        stats['idle']          = self.__idle.qsize()
+        stats['avg_wait_time'] = stats['wait_time'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def __checkout(self):
+        # Prefer an idle connection, then open a new one if under the limit, then wait.
+        try:
+            return self.__idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.__lock:
+            can_open = self.__opened < self.size
+            if can_open:
+                self.__opened += 1
+
+        if can_open:
+            try:
+                return self.__factory(), None
+            except Exception:
+                with self.__lock:
+                    self.__opened -= 1
+                raise
+
+        with self.__lock:
+            self.__stats['waits'] += 1
+        try:
+            return self.__idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self.__lock:
+                self.__stats['timeouts'] += 1
+            raise PoolTimeout("No database connection became available within " + str(self.timeout) + " seconds")
+
+    def __ping(self, cnx):
+        try:
+            cnx.ping(reconnect=True, attempts=2, delay=1)
+            with self.__lock:
+                self.__stats['pings'] += 1
+            return cnx
+        except Exception:
+            pass
+
+        # The old socket is unusable; replace it with a fresh connection in the same slot.
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        try:
+            cnx = self.__factory()
+        except Exception:
+            with self.__lock:
+                self.__opened -= 1
+            raise
+        with self.__lock:
+            self.__stats['reconnects'] += 1
+        return cnx
+
+    def __discard(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        with self.__lock:
+            self.__opened -= 1
+            self.__stats['discarded'] += 1
+
 if __name__ == "__main__":
-    connect(0,0,0)
\ No newline at end of file
+    connect()
@@ -0,0 +1,756 @@
+import re
+import sys
+import json
+import time
+import types
+import decimal
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+from unittest import mock
+
+from flask import Flask
+
+from score_cache import ScoreCache
+from sqlconnector import ConnectionPool, PoolTimeout
+from response_cache import ResponseCache
+from etags import rows_etag, conditional
+from idempotency import IdempotencyStore, IdempotencyMismatch, IdempotencyInProgress
+from jobs import ScoringJobs, JobQueueFull
+from serializer import dumps, rows_to, to_package, to_rating, to_export_record
+
+# MySQL spellings used by the service modules and their SQLite equivalents
+SQL_TRANSLATIONS = [
+    (r"UTC_TIMESTAMP\(\) - INTERVAL %s SECOND", "utc_ago(%s)"),
+    (r"UTC_TIMESTAMP\(\)",                      "utc_now()"),
+    (r"ROW_COUNT\(\)",                          "changes()"),
+    (r"MAX\(updated_at\)",                      'MAX(updated_at) AS "updated_at [DATETIME]"'),
+    (r"INSERT IGNORE",                          "INSERT OR IGNORE"),
+    (r"%s",                                     "?"),
+]
+SQL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+sqlite3.register_converter("DATETIME", lambda value: datetime.datetime.strptime(value.decode(), SQL_TIME_FORMAT))
+
+class SQLiteCursor():
+    # A cursor with the parts of the mysql.connector cursor interface the service modules use,
+    # running their queries against SQLite. information_schema lookups of a table's columns are
+    # answered from SQLite's own table_info. close() forgets the result and its column names, as
+    # closing a buffered mysql.connector cursor does.
+
+    def __init__(self, pool):
+        self.pool         = pool
+        self.rows         = []
+        self.rowcount     = -1
+        self.column_names = ()
+
+    def execute(self, query, params=()):
+        if "information_schema" in query:
+            table     = re.search(r"TABLE_NAME = '(\w+)'", query).group(1)
+            self.rows = [(column[1],) for column in self.pool.db.execute("PRAGMA table_info(" + table + ")")]
+            return
+        for mysql, sqlite in SQL_TRANSLATIONS:
+            query = re.sub(mysql, sqlite, query)
+
+        with self.pool.lock:
+            cursor            = self.pool.db.execute(query, params)
+            self.rows         = cursor.fetchall()
+            self.rowcount     = cursor.rowcount
+            self.column_names = tuple(column[0] for column in cursor.description or ())
+
+    def executemany(self, query, rows):
+        for row in rows:
+            self.execute(query, row)
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.rows         = []
+        self.column_names = ()
+
+class SQLiteConnection():
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, buffered=False):
+        return SQLiteCursor(self.pool)
+
+    def commit(self):
+        with self.pool.lock:
+            self.pool.db.commit()
+
+    def rollback(self):
+        with self.pool.lock:
+            self.pool.db.rollback()
+
+class SQLitePool():
+    # Stands in for sqlconnector.ConnectionPool with one in-memory SQLite database. UTC_TIMESTAMP()
+    # is the current time plus 'offset' seconds, so a test can move the clock forward.
+
+    def __init__(self):
+        self.offset    = 0
+        self.discarded = 0
+        self.lock      = threading.Lock()
+        self.db     = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, check_same_thread=False)
+        self.db.create_function("utc_now", 0, lambda: self.now().strftime(SQL_TIME_FORMAT))
+        self.db.create_function("utc_ago", 1, lambda seconds: (self.now() - datetime.timedelta(seconds=seconds)).strftime(SQL_TIME_FORMAT))
+
+    def now(self):
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=self.offset)
+
+    def acquire(self):
+        return SQLiteConnection(self)
+
+    def release(self, cnx):
+        cnx.rollback()
+
+    def discard(self, cnx):
+        self.discarded += 1
+
+    @contextmanager
+    def connection(self):
+        cnx = self.acquire()
+        try:
+            yield cnx
+        finally:
+            self.release(cnx)
+
+# The package table as it stands once sqlconnector.migrate has run
+PACKAGE_TABLE = """
+CREATE TABLE package (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    package_id VARCHAR(255) NOT NULL,
+    package_name VARCHAR(255) NOT NULL,
+    version VARCHAR(255) NOT NULL,
+    url VARCHAR(255) NULL,
+    jsprogram TEXT NULL,
+    content TEXT NULL,
+    ramp_up FLOAT NULL,
+    correctness FLOAT NULL,
+    bus_factor FLOAT NULL,
+    responsiveness FLOAT NULL,
+    license FLOAT NULL,
+    dependancy FLOAT NULL,
+    overall FLOAT NULL,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    row_version INTEGER NOT NULL DEFAULT 1,
+    scored_at DATETIME NULL,
+    imputed VARCHAR(255) NULL
+)"""
+
+services = {}
+
+def service():
+    # main.py, imported once with an in-memory SQLite database in place of Cloud SQL and without the
+    # Cloud Storage uploads, its package table and response cache emptied. Routes are called through
+    # service().app.test_client(). Tests replace the scoring functions they reach with mock.patch.object.
+    if "main" not in services:
+        pool = SQLitePool()
+        pool.db.execute(PACKAGE_TABLE)
+        storage = types.ModuleType("storage")
+        storage.uploadFiles = storage.downloadFiles = lambda *args: None
+
+        previous = sys.modules.get("storage")
+        sys.modules["storage"] = storage
+        try:
+            with mock.patch("sqlconnector.ConnectionPool", lambda: pool):
+                import main
+        finally:
+            if previous is None:
+                del sys.modules["storage"]
+            else:
+                sys.modules["storage"] = previous
+        services["main"] = main
+
+    main = services["main"]
+    with main.pool.lock:
+        main.pool.db.execute("DELETE FROM package")
+        main.pool.db.commit()
+    main.response_cache.clear()
+    return main
+
+def add_packages(main, ids):
+    # Inserts a scored package named after each ID
+    with main.pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        for id in ids:
+            cursor.execute("INSERT INTO package (package_id, package_name, version, url, overall, scored_at) VALUES (%s,%s,%s,%s,%s,UTC_TIMESTAMP())",
+                    (id, "name-" + id, "1.0.0", "https://github.com/owner/" + id, 0.5))
+        cnx.commit()
+        cursor.close()
+
+def wait_for(condition, seconds=5):
+    # Polls 'condition' until it holds or 'seconds' pass. Returns whether it held.
+    deadline = time.monotonic() + seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        threading.Event().wait(0.01)
+    return True
+
+def test_score_cache():
+    # Stored scores should be returned for the same repository, commit and metrics version only, until
+    # they are older than the TTL. Scores stored without a time should get the time they were stored.
+    # Invalidating a repository, as DELETE /scores/cache?repo= does, should delete only its scores.
+
+    pool  = SQLitePool()
+    cache = ScoreCache(pool, ttl=60)
+    cache.create_table()
+
+    missed = cache.get("owner/repo", "a" * 40, "1+abc")
+    cache.put("owner/repo", "a" * 40, "1+abc", {"score": 0.5})
+    cache.put("owner/other", "b" * 40, "1+abc", {"score": 0.7, "scored_at": "2021-12-01 12:00:00"})
+    hit           = cache.get("owner/repo", "a" * 40, "1+abc")
+    other_version = cache.get("owner/repo", "a" * 40, "2+abc")
+    other_head    = cache.get("owner/repo", "c" * 40, "1+abc")
+    other         = cache.get("owner/other", "b" * 40, "1+abc")
+
+    if missed is not None or other_version is not None or other_head is not None:
+        print("Scores should only be returned for the repository, commit and metrics version they were stored under.")
+        return False
+    if hit is None or hit["score"] != 0.5 or not hit.get("scored_at"):
+        print(f"Stored scores should be returned with the time they were stored, but got {hit}.")
+        return False
+    if other["scored_at"] != "2021-12-01 12:00:00":
+        print(f"Scores should keep the time they were computed, but got {other['scored_at']}.")
+        return False
+
+    pool.offset = 120
+    expired     = cache.get("owner/repo", "a" * 40, "1+abc")
+    pool.offset = 0
+    deleted     = cache.invalidate("owner/repo")
+    kept        = cache.get("owner/other", "b" * 40, "1+abc")
+
+    if expired is not None:
+        print("Scores older than the TTL should not be returned.")
+        return False
+    if deleted != 1 or kept is None or cache.get("owner/repo", "a" * 40, "1+abc") is not None:
+        print(f"Invalidating one repository should delete its scores only, but {deleted} were deleted.")
+        return False
+
+    stats = cache.stats()
+    if stats["hits"] != 3 or stats["stores"] != 2 or stats["invalidations"] != 1:
+        print(f"The cache should count 3 hits, 2 stores and 1 invalidation, but it counted {stats}.")
+        return False
+
+    return True
+
+class FakeConnection():
+    # A database connection that counts rollbacks and can be made to fail them.
+
+    def __init__(self, broken=False):
+        self.broken    = broken
+        self.rollbacks = 0
+        self.closed    = False
+        self.shut_down = False
+
+    def rollback(self):
+        if self.broken:
+            raise Exception("connection lost")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+    def shutdown(self):
+        self.shut_down = True
+
+def test_connection_pool():
+    # The pool should reuse a returned connection and roll back what its user left open. With every
+    # connection checked out it should wait, then raise PoolTimeout. A connection that fails its rollback
+    # should be closed and its slot freed for a new one, as should one discarded by its user, without
+    # being rolled back.
+
+    opened = []
+    def factory():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    pool = ConnectionPool(size=1, timeout=0.1, factory=factory)
+    with pool.connection() as cnx:
+        first = cnx
+        try:
+            pool.acquire()
+            timed_out = False
+        except PoolTimeout:
+            timed_out = True
+    with pool.connection() as cnx:
+        reused = cnx is first
+        cnx.broken = True
+    with pool.connection() as cnx:
+        replaced = cnx is not first
+    stats = pool.stats()
+
+    abandoned = pool.acquire()
+    rollbacks = abandoned.rollbacks
+    pool.discard(abandoned)
+    if not timed_out or stats["timeouts"] != 1:
+        print("Checking out more connections than the pool holds should time out.")
+        return False
+    if not reused or first.rollbacks != 1:
+        print("A returned connection should be rolled back and handed out again.")
+        return False
+    if not replaced or not first.closed or len(opened) != 2 or stats["discarded"] != 1 or stats["in_use"] != 0:
+        print(f"A connection that fails its rollback should be closed and replaced, but the pool reports {stats}.")
+        return False
+    if not abandoned.shut_down or abandoned.rollbacks != rollbacks or pool.stats()["discarded"] != 2 or pool.stats()["in_use"] != 0:
+        print(f"A discarded connection should be shut down without a rollback, but the pool reports {pool.stats()}.")
+        return False
+
+    return True
+
+def test_response_cache():
+    # Cached responses should be evicted least recently used first and expire after the TTL. Invalidating
+    # a tag should drop every response carrying it, and a response loaded before an invalidation should
+    # not be stored.
+
+    cache = ResponseCache(size=2, ttl=60)
+    cache.put("a", "A", ["id:1"], cache.generation())
+    cache.put("b", "B", ["id:2", "name:b"], cache.generation())
+    cache.get("a")
+    cache.put("c", "C", ["id:3"], cache.generation())
+    evicted = cache.get("b") is None and cache.get("a") == "A" and cache.get("c") == "C"
+
+    generation = cache.generation()
+    cache.invalidate(["id:1"])
+    cache.put("d", "D", ["id:4"], generation)
+    invalidated = cache.get("a") is None and cache.get("c") == "C" and cache.get("d") is None
+
+    expiring = ResponseCache(ttl=-1)
+    expiring.put("a", "A", [], expiring.generation())
+    expired = expiring.get("a") is None and expiring.stats()["expirations"] == 1
+
+    if not evicted:
+        print("The least recently used response should be evicted once the cache is full.")
+        return False
+    if not invalidated or cache.stats()["stale_stores"] != 1:
+        print(f"Invalidation should drop the tagged response and refuse stale stores, but the cache reports {cache.stats()}.")
+        return False
+    if not expired:
+        print("A response older than the TTL should not be served.")
+        return False
+
+    return True
+
+def test_etags():
+    # A row's ETag should change with its row_version and its primary key, and a listing of several rows
+    # should get one tag. A request naming the current ETag should get a 304 without the body being built.
+
+    row     = {'id': 5, 'row_version': 3}
+    updated = {'id': 5, 'row_version': 4}
+    created = {'id': 6, 'row_version': 3}
+    tags    = [rows_etag([row]), rows_etag([updated]), rows_etag([created]), rows_etag([row, created]), rows_etag([updated, created])]
+    if tags[0] != "5.3" or len(set(tags)) != len(tags):
+        print(f"Every change to the rows should change their ETag, but the tags were {tags}.")
+        return False
+
+    app   = Flask(__name__)
+    built = []
+    def body():
+        built.append(1)
+        return "body"
+    with app.test_request_context(headers={'If-None-Match': '"5.3"'}):
+        not_modified = conditional("5.3", body)
+    with app.test_request_context(headers={'If-None-Match': '"5.2"'}):
+        modified = conditional("5.3", body)
+
+    if not_modified != ('', 304, {'ETag': '"5.3"'}) or modified != ("body", 200, {'ETag': '"5.3"'}) or len(built) != 1:
+        print(f"Only a request naming the current ETag should get a 304, but the responses were {not_modified} and {modified}.")
+        return False
+
+    return True
+
+def test_idempotency_store():
+    # The first request with a key should claim it and a retry of it, once finished, should get its
+    # status, headers and body back. Reusing the key for another request should raise IdempotencyMismatch,
+    # and retrying a request still running should raise IdempotencyInProgress once the wait is over. An
+    # abandoned key, or one whose owner has been running for longer than 'stale', can be claimed again.
+
+    pool  = SQLitePool()
+    store = IdempotencyStore(pool, ttl=600, wait=0, stale=60)
+    store.create_table()
+
+    claimed = store.begin("key-1", "hash-1")
+    try:
+        store.begin("key-1", "hash-1")
+        in_progress = False
+    except IdempotencyInProgress:
+        in_progress = True
+    store.finish("key-1", 201, '{"id": 1}', {'Content-Type': 'application/json', 'ETag': '"1.1"'})
+    replayed = store.begin("key-1", "hash-1")
+    try:
+        store.begin("key-1", "hash-2")
+        mismatched = False
+    except IdempotencyMismatch:
+        mismatched = True
+
+    if claimed is not None or not in_progress:
+        print("A new key should be claimed, and a retry while it runs should raise IdempotencyInProgress.")
+        return False
+    if replayed != ('{"id": 1}', 201, {'Content-Type': 'application/json', 'ETag': '"1.1"'}):
+        print(f"A retry of a finished request should replay its response, but got {replayed}.")
+        return False
+    if not mismatched:
+        print("Reusing a key for a different request should raise IdempotencyMismatch.")
+        return False
+
+    store.begin("key-2", "hash-1")
+    store.abandon("key-2")
+    reclaimed = store.begin("key-2", "hash-1")
+    store.begin("key-3", "hash-1")
+    pool.offset = 120
+    taken_over  = store.begin("key-3", "hash-1")
+    pool.offset = 1200
+    expired     = store.begin("key-1", "hash-1")
+
+    stats = store.stats()
+    if reclaimed is not None or taken_over is not None or stats['abandoned'] != 1 or stats['takeovers'] != 1:
+        print(f"Abandoned and stale keys should be claimed again, but the store reports {stats}.")
+        return False
+    if expired is not None:
+        print("A key older than the TTL should be claimed again instead of replayed.")
+        return False
+
+    return True
+
+def test_scoring_jobs():
+    # A job should go from queued to running to done, or to failed with its error. A deduped submit for a
+    # package whose job is running should get that job back, and a submit past the queue bound should raise
+    # JobQueueFull. Once more than 'history' jobs are held the oldest finished ones should be dropped.
+
+    jobs    = ScoringJobs(workers=1, max_queued=1, history=2)
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        return {"score": 1}
+
+    def fail():
+        raise Exception("repository not found")
+
+    first   = jobs.submit("a", work)
+    running = wait_for(lambda: jobs.get(first["JobID"])["Status"] == "running")
+    deduped = jobs.submit("a", work, dedupe=True)
+    queued  = jobs.submit("b", fail)
+    try:
+        jobs.submit("c", work)
+        full = False
+    except JobQueueFull:
+        full = True
+    release.set()
+    finished = wait_for(lambda: jobs.get(queued["JobID"])["Status"] == "failed")
+
+    if not running or queued["Status"] != "queued":
+        print("A submitted job should be queued until a worker is free to run it.")
+        return False
+    if deduped["JobID"] != first["JobID"] or not full:
+        print("A deduped submit should return the running job, and a submit past the bound should raise JobQueueFull.")
+        return False
+    done, failed = jobs.get(first["JobID"]), jobs.get(queued["JobID"])
+    if not finished or done["Status"] != "done" or done["Result"] != {"score": 1} or failed["Error"] != "repository not found":
+        print(f"Jobs should finish with their result or error, but they ended as {done} and {failed}.")
+        return False
+
+    jobs.submit("d", lambda: {})
+    if jobs.get(first["JobID"]) is not None or jobs.latest_for_package("a") is not None or jobs.get(queued["JobID"]) is None:
+        print("Only the oldest finished job should be dropped once more than 'history' jobs are held.")
+        return False
+
+    return True
+
+def test_serializer():
+    # Rows should serialize to the API's field names with Decimal scores as numbers, dates and datetimes
+    # in ISO 8601, bytes as text and NULLs as null. Columns a row lacks should be left out.
+
+    columns = ("package_id", "package_name", "version", "content", "url", "jsprogram", "ramp_up", "correctness", "overall",
+               "scored_at", "updated_at", "imputed")
+    row     = ("p1", "name", "1.0.0", b"UEsDBA==", "https://github.com/owner/p1", None, decimal.Decimal("0.25"), None, decimal.Decimal("0.5"),
+               datetime.datetime(2021, 12, 1, 12, 30, 5), datetime.date(2021, 12, 2), "bus_factor,license")
+
+    record = json.loads(dumps(to_export_record(dict(zip(columns, row)))))
+    listed = json.loads(rows_to(columns, [row], to_package))
+    rating = json.loads(dumps(to_rating({"overall": None})))
+
+    expected = {
+        "metadata" : {"Name": "name", "Version": "1.0.0", "ID": "p1"},
+        "data"     : {"Content": "UEsDBA==", "URL": "https://github.com/owner/p1", "JSProgram": None},
+        "rating"   : {"RampUp": 0.25, "Correctness": None, "NetScore": 0.5, "ScoredAt": "2021-12-01T12:30:05", "Imputed": ["bus_factor", "license"]},
+        "UpdatedAt": "2021-12-02",
+    }
+    if record != expected:
+        print(f"The row should serialize as {expected}, but it serialized as {record}.")
+        return False
+    if listed != [{"metadata": expected["metadata"], "data": expected["data"]}] or rating != {"NetScore": None}:
+        print(f"Listed rows should serialize like single rows, but got {listed} and {rating}.")
+        return False
+
+    return True
+
+def test_cursor_pages():
+    # Following 'next' from an empty cursor should return every package once, in order, even when rows
+    # already read are deleted and new ones are added between pages. A cursor this server did not issue
+    # should get a 400.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p" + str(i) for i in range(1, 8)])
+
+    ids   = []
+    token = ""
+    pages = 0
+    while token is not None and pages < 10:
+        response = client.get("/packages/", query_string={"cursor": token, "page_size": 3})
+        page     = json.loads(response.data)
+        ids     += [package["ID"] for package in page["packages"]]
+        token    = page["next"]
+        pages   += 1
+        if pages == 1:
+            deleted = client.delete("/package/p1").status_code
+            add_packages(main, ["p8"])
+
+    if deleted != 200 or ids != ["p" + str(i) for i in range(1, 9)] or pages != 3:
+        print(f"Cursor pages should return p1 to p8 once each in 3 pages, but returned {ids} in {pages}.")
+        return False
+    if client.get("/packages/", query_string={"cursor": "not-a-cursor"}).status_code != 400:
+        print("A cursor the server did not issue should be rejected with a 400.")
+        return False
+
+    return True
+
+def test_export_abandoned():
+    # A finished export should return its connection to the pool. One the client stops reading midway
+    # should have its connection discarded instead of rolled back, which would read every remaining row.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p" + str(i) for i in range(1, 6)])
+
+    with mock.patch.object(main, "EXPORT_BATCH", 2):
+        full      = client.get("/packages/export").data.decode().splitlines()
+        discarded = main.pool.discarded
+        response  = client.get("/packages/export", buffered = False)
+        first     = next(iter(response.response))
+        response.close()
+
+    if [json.loads(line)["metadata"]["ID"] for line in full] != ["p" + str(i) for i in range(1, 6)] or discarded != 0:
+        print(f"A finished export should list every package and release its connection, but it listed {full}.")
+        return False
+    if json.loads(first)["metadata"]["ID"] != "p1" or main.pool.discarded != 1:
+        print("An export abandoned midway should discard its connection.")
+        return False
+
+    return True
+
+def package(id, repo = None):
+    # A Package object as POSTed to /package
+    return {"metadata": {"Name": "name-" + id, "Version": "1.0.0", "ID": id}, "data": {"URL": "https://github.com/owner/" + (repo or id), "JSProgram": ""}}
+
+def score_urls(urls, cache = None, threshold = None):
+    # Stands in for helper.score_packages: every repository passes ingestibility except "weak", which
+    # fails it, and "gone", which cannot be scored
+    scores = {}
+    for url in urls:
+        value = 0 if url.endswith("/weak") else .5
+        scores[url] = {"ramp_up": value, "correctness": value, "bus_factor": value, "responsiveness": value, "license": value,
+                       "dependency": value, "score": value, "scored_at": "2021-12-01 12:00:00"}
+        if url.endswith("/gone"):
+            scores[url] = Exception("repository not found")
+    return scores
+
+def stored_ids(main, scored = False):
+    # The package IDs in the package table, or only those with scores stored
+    query = "SELECT package_id FROM package" + (" WHERE overall IS NOT NULL" if scored else "") + " ORDER BY id"
+    with main.pool.lock:
+        return [row[0] for row in main.pool.db.execute(query)]
+
+def test_batch_create():
+    # Every item of a batch should get a Status in input order: created, invalid, duplicate (of an earlier
+    # item or an existing package), rejected or failed, and only created items should be stored. An async
+    # batch larger than the job queue should be queued as one job that stores every passing package.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p0"])
+
+    batch = [package("p1"), {"metadata": {"Name": "x", "ID": "p9"}, "data": {}}, package("p1"), package("p0"), package("p2", "weak"), package("p3", "gone")]
+    with mock.patch.object(main, "score_packages", score_urls):
+        response = client.post("/packages/batch", json = batch)
+    results  = json.loads(response.data)["results"]
+    statuses = [result["Status"] for result in results]
+
+    if response.status_code != 200 or statuses != ["created", "invalid", "duplicate", "duplicate", "rejected", "failed"]:
+        print(f"The batch items should be created, invalid, duplicate, duplicate, rejected and failed, but they were {statuses}.")
+        return False
+    if stored_ids(main) != ["p0", "p1"]:
+        print(f"Only the created package should be stored, but {stored_ids(main)} are.")
+        return False
+
+    batch = [package("a" + str(i)) for i in range(1, 12)] + [package("a12", "weak")]
+    with mock.patch.object(main, "score_packages", score_urls), mock.patch.object(main, "scoring_jobs", ScoringJobs(workers = 1, max_queued = 1)):
+        response = client.post("/packages/batch", json = batch, query_string = {"mode": "async"})
+        results  = json.loads(response.data)["results"]
+        job_ids  = {result.get("JobID") for result in results}
+        finished = wait_for(lambda: main.scoring_jobs.get(results[0]["JobID"])["Status"] == "done")
+        status   = client.get("/package/a5/rate/status")
+
+    if response.status_code != 202 or {result["Status"] for result in results} != {"queued"} or len(job_ids) != 1:
+        print(f"Every package of an async batch should be queued on one job, but the results were {results}.")
+        return False
+    if not finished or stored_ids(main) != stored_ids(main, scored = True) or stored_ids(main) != ["p0", "p1"] + ["a" + str(i) for i in range(1, 12)]:
+        print(f"The batch job should store every package that passes ingestibility, but {stored_ids(main)} are stored.")
+        return False
+    if json.loads(status.data)["Result"]["results"][-1] != {"ID": "a12", "Status": "rejected"}:
+        print(f"Each package's status should show the batch job, but it showed {status.data}.")
+        return False
+
+    return True
+
+def test_by_ids():
+    # Packages looked up over several IN queries should all be found, with each ID asked for twice returned
+    # once and the IDs not in the registry listed as missing in the order given. 'include' should limit
+    # the response to packages or ratings.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p1", "p2", "p3", "p4", "p5"])
+
+    with mock.patch.object(main, "IN_CHUNK", 2):
+        both     = json.loads(client.post("/packages/byIds", json = ["p5", "x1", "p1", "p3", "p1", "x2", "p4"]).data)
+        packages = json.loads(client.post("/packages/byIds", json = {"IDs": ["p2", "x3"], "include": ["package"]}).data)
+    invalid = client.post("/packages/byIds", json = {"IDs": ["p2"], "include": ["history"]}).status_code
+
+    if sorted(both["packages"]) != ["p1", "p3", "p4", "p5"] or sorted(both["ratings"]) != ["p1", "p3", "p4", "p5"] or both["missing"] != ["x1", "x2"]:
+        print(f"Packages p1, p3, p4 and p5 should be found and x1 and x2 missing, but the response was {both}.")
+        return False
+    if both["packages"]["p3"]["metadata"] != {"Name": "name-p3", "Version": "1.0.0", "ID": "p3"} or both["ratings"]["p3"]["NetScore"] != .5:
+        print(f"Each found ID should map to its own package and rating, but p3 got {both['packages']['p3']} and {both['ratings']['p3']}.")
+        return False
+    if set(packages) != {"packages", "missing"} or packages["missing"] != ["x3"] or invalid != 400:
+        print(f"'include' should limit the response to what it lists, but the response was {packages}.")
+        return False
+
+    return True
+
+def test_package_routes():
+    # GET /package/<id> and /package/<id>/rate should serve the stored row with its ETag, answer a request
+    # naming that ETag with a 304, and serve the new row once it changes. An unknown ID should get a 400.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p1"])
+
+    package = client.get("/package/p1")
+    rating  = client.get("/package/p1/rate")
+    cached  = client.get("/package/p1", headers = {"If-None-Match": package.headers.get("ETag", "")})
+    with main.pool.connection() as cnx:
+        cursor = cnx.cursor(buffered = True)
+        cursor.execute("UPDATE package SET version = '2.0.0', row_version = row_version + 1 WHERE package_id = 'p1'")
+        cnx.commit()
+        cursor.close()
+    main.afterWrite(ids = ["p1"])
+    changed = client.get("/package/p1", headers = {"If-None-Match": package.headers.get("ETag", "")})
+    missing = client.get("/package/p9")
+
+    if package.status_code != 200 or json.loads(package.data)["metadata"] != {"Name": "name-p1", "Version": "1.0.0", "ID": "p1"}:
+        print(f"GET /package/p1 should return the package, but returned {package.status_code} {package.data}.")
+        return False
+    if rating.status_code != 200 or json.loads(rating.data)["NetScore"] != .5:
+        print(f"GET /package/p1/rate should return the rating, but returned {rating.status_code} {rating.data}.")
+        return False
+    if cached.status_code != 304 or changed.status_code != 200 or json.loads(changed.data)["metadata"]["Version"] != "2.0.0":
+        print(f"Only an unchanged package should get a 304, but the responses were {cached.status_code} and {changed.status_code}.")
+        return False
+    if missing.status_code != 400:
+        print("An unknown package should get a 400.")
+        return False
+
+    return True
+
+def test_stale_rescore():
+    # GET /rate on stale scores should rescore the package without reading the score cache and store the
+    # new ScoredAt. After a failed rescore, reads should not queue another until RESCORE_BACKOFF has passed.
+
+    main   = service()
+    client = main.app.test_client()
+    add_packages(main, ["p1", "p2"])
+    with main.pool.lock:
+        main.pool.db.execute("UPDATE package SET scored_at = '2021-12-01 12:00:00', url = 'https://github.com/owner/gone' WHERE package_id = 'p2'")
+        main.pool.db.execute("UPDATE package SET scored_at = '2021-12-01 12:00:00' WHERE package_id = 'p1'")
+        main.pool.db.commit()
+
+    refreshed = []
+    def score_package(url, cache = None, threshold = None, refresh = False):
+        refreshed.append(refresh)
+        scores = score_urls([url])[url]
+        if isinstance(scores, Exception):
+            raise scores
+        scores["scored_at"] = datetime.datetime.utcnow().strftime(SQL_TIME_FORMAT)
+        return scores
+
+    jobs = ScoringJobs(workers = 1)
+    with mock.patch.object(main, "score_package", score_package), mock.patch.object(main, "scoring_jobs", jobs):
+        client.get("/package/p1/rate")
+        rescored = wait_for(lambda: jobs.latest_for_package("p1")["Status"] == "done")
+        rating   = json.loads(client.get("/package/p1/rate").data)
+
+        client.get("/package/p2/rate")
+        failed = wait_for(lambda: jobs.latest_for_package("p2")["Status"] == "failed")
+        first  = jobs.latest_for_package("p2")["JobID"]
+        client.get("/package/p2/rate")
+        backed_off = jobs.latest_for_package("p2")["JobID"] == first
+        with mock.patch.object(main, "RESCORE_BACKOFF", -1):
+            client.get("/package/p2/rate")
+        retried = jobs.latest_for_package("p2")["JobID"] != first
+        wait_for(lambda: jobs.latest_for_package("p2")["Status"] == "failed")
+
+    if not rescored or refreshed[0] is not True or rating["ScoredAt"] < datetime.datetime.utcnow().strftime("%Y-%m-%d"):
+        print(f"A stale rating should be rescored past the score cache with a new ScoredAt, but it was {rating}.")
+        return False
+    if not failed or not backed_off or not retried:
+        print("A failed rescore should only be retried once RESCORE_BACKOFF has passed.")
+        return False
+
+    return True
+
+def test():
+    # Runs the tests of main.py's routes and of the service modules next to it. They need no database or
+    # network: the modules that store data, and main.py itself (see service()), are given an in-memory
+    # SQLite database through SQLitePool. Each test returns True if it passes; the number of tests passed
+    # and run is printed at the end.
+
+    tests = [
+        test_score_cache,
+        test_connection_pool,
+        test_response_cache,
+        test_etags,
+        test_idempotency_store,
+        test_scoring_jobs,
+        test_serializer,
+        test_cursor_pages,
+        test_export_abandoned,
+        test_batch_create,
+        test_by_ids,
+        test_package_routes,
+        test_stale_rescore,
+    ]
+
+    num_passes = 0
+    for test in tests:
+        if test():
+            num_passes += 1
+
+    print(str(num_passes) + "/" + str(len(tests)))
+
+if __name__ == "__main__":
+    test()